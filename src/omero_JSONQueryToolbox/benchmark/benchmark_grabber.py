@@ -0,0 +1,176 @@
+# coding=utf-8
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os.path
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+#####################################################################################################
+# Benchmark of omeroJSON_grabber.py against omero_stub_server.py.
+#
+# For every number of images the stub server is started in its own process with one dataset holding
+# all images, then run_script() of the grabber is called in this process for that dataset (without
+# session cache, metadata cache and output files) and the following is reported as JSON line:
+# - wall time of run_script() and requests per second
+# - p50 and p95 of the request latency seen by the grabber: from calling omero_request() (or its asyncio
+#   version) to the response, including waiting for a connection, the rate limiter, retries and network
+# - p50 and p95 of the request handling time measured by the stub server (server_p50_ms, server_p95_ms)
+# - peak memory allocated by the grabber (tracemalloc), measured in a second run, as tracing slows the
+#   grabber down
+#
+# Example:
+#   python3 benchmark_grabber.py --images 10 1000 100000 --latency-ms 5 --workers 8
+#####################################################################################################
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GRABBER = os.path.join(HERE, os.pardir, 'omeroJSON_grabber.py')
+STUB_SERVER = os.path.join(HERE, 'omero_stub_server.py')
+OWNER = 'eln_user'
+
+
+def percentile(values, p):
+    # returns the p-th percentile (nearest rank) of values, 0 if there are none
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+@contextlib.contextmanager
+def stub_server(images, latency_ms, error_rate, max_limit, other_owner_every):
+    # starts the stub server in its own process, so its memory is not counted, and yields its url
+    proc = subprocess.Popen([sys.executable, STUB_SERVER, '--port', '0', '--images', str(images),
+                             '--latency-ms', str(latency_ms), '--error-rate', str(error_rate),
+                             '--max-limit', str(max_limit), '--other-owner-every', str(other_owner_every)],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        base = proc.stdout.readline().strip().split()[-1]
+        yield base
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def stub_request(base, path, data=None):
+    with urllib.request.urlopen(base + path, data=data) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def time_requests(grabber):
+    # wraps the request functions of the grabber, returns the list the latency of every request is appended to
+    latencies = []
+    request, request_async = grabber.omero_request, grabber.omero_request_async
+
+    def omero_request(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def omero_request_async(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request_async(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    grabber.omero_request = omero_request
+    grabber.omero_request_async = omero_request_async
+    return latencies
+
+
+def load_grabber(base):
+    # loads a fresh copy of the grabber configured for the stub server
+    spec = importlib.util.spec_from_file_location('omeroJSON_grabber', GRABBER)
+    grabber = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(grabber)
+    grabber.OMERO_WEB_HOST = base
+    grabber.SESSION_CACHE = ''
+    grabber.METADATA_CACHE = ''
+    grabber.SAVE_OUTPUT = False
+    return grabber
+
+
+def run_grabber(grabber, argv):
+    # calls run_script() of the grabber with argv, returns the wall time in seconds
+    old_argv, sys.argv = sys.argv, argv
+    start = time.perf_counter()
+    try:
+        # the grabber prints the metadata dictionary, which is not part of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            grabber.run_script()
+    finally:
+        seconds = time.perf_counter() - start
+        sys.argv = old_argv
+    return seconds
+
+
+def run_benchmark(images, args):
+    with stub_server(images, args.latency_ms, args.error_rate, args.max_limit, args.other_owner_every) as base:
+        argv = ['omeroJSON_grabber.py', '-o', OWNER, '-n', 'benchmark', '-d', 'DATASET', '-i', '1',
+                '--workers', str(args.workers), '--engine', args.engine, '--page-size', str(args.page_size)]
+        if args.bulk:
+            argv.append('--bulk')
+        grabber = load_grabber(base)
+        latencies = time_requests(grabber)
+        stub_request(base, '/stub/reset', data=b'')
+        seconds = run_grabber(grabber, argv)
+        stats = stub_request(base, '/stub/stats')
+        # the same run again with a fresh grabber for the memory, not timed
+        tracemalloc.start()
+        try:
+            run_grabber(load_grabber(base), argv)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    server_latencies = stats['latencies']
+    return {'images': images,
+            'engine': args.engine,
+            'workers': args.workers,
+            'bulk': args.bulk,
+            'latency_ms': args.latency_ms,
+            'error_rate': args.error_rate,
+            'seconds': round(seconds, 3),
+            'requests': stats['requests'],
+            'requests_per_second': round(stats['requests'] / seconds, 1) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000.0, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000.0, 2),
+            'server_p50_ms': round(percentile(server_latencies, 50) * 1000.0, 2),
+            'server_p95_ms': round(percentile(server_latencies, 95) * 1000.0, 2),
+            'peak_memory_mb': round(peak / 1048576.0, 2),
+            'paths': stats['paths']}
+
+
+def run_script():
+    parser = argparse.ArgumentParser(prog="benchmark_grabber")
+    parser.add_argument('--images', type=int, nargs='+', default=[10, 1000, 100000],
+                        help='numbers of images to benchmark')
+    parser.add_argument('--engine', default='threads', choices=['threads', 'asyncio'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with 500')
+    parser.add_argument('--max-limit', type=int, default=500, help='largest page the stub server returns')
+    parser.add_argument('--other-owner-every', type=int, default=0,
+                        help='every n-th image belongs to another user')
+    parser.add_argument('--output', help='append the results to this file as JSON lines')
+    args = parser.parse_args()
+
+    for images in args.images:
+        line = json.dumps(run_benchmark(images, args))
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + '\n')
+
+
+if __name__ == "__main__":
+    run_script()
@@ -0,0 +1,255 @@
+# coding=utf-8
+import argparse
+import json
+import random
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#####################################################################################################
+# Stand-in for the parts of the OMERO.web JSON API used by omeroJSON_grabber.py, to test and
+# benchmark the grabber without a real OMERO server.
+#
+# Endpoints: /api/, token, servers, login, m/images/, m/images/{id}/, m/datasets/{id}/images/,
+# m/projects/{id}/datasets/, m/screens/{id}/plates/ and m/plates/{id}/wells/ (listings with limit and offset)
+#
+# Synthetic data:
+# - images 1..N, all owned by OWNER (every OTHER_OWNER_EVERY-th image belongs to 'someone_else')
+# - datasets 1..D, dataset d holds the images ((d-1)*per_dataset+1) .. d*per_dataset
+# - projects 1..P, project p holds the datasets d with (d-1) % P == p-1, project 1 holds all datasets
+# - plates 1..D, plate d has one well per image of dataset d
+# - screens 1..S, screen s holds the plates d with (d-1) % S == s-1
+#
+# Options:
+# - LATENCY_MS is added to every request, ERROR_RATE of the requests fail with status 500
+# - MAX_LIMIT is the largest page of a listing (OMERO.web's API_MAX_LIMIT)
+#
+# GET /stub/stats returns the number of requests per path and the handling time of every request,
+# POST /stub/reset sets them back to zero.
+#####################################################################################################
+
+OWNER = 'eln_user'
+
+
+class StubState:
+    def __init__(self, images, datasets, latency_ms, error_rate, max_limit, other_owner_every, projects=1,
+                 screens=1):
+        self.images = images
+        self.datasets = datasets
+        self.projects = projects
+        self.screens = screens
+        self.per_dataset = max(1, images // max(1, datasets))
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.max_limit = max_limit
+        self.other_owner_every = other_owner_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.paths = {}
+        self.latencies = []
+        self.sessions = set()
+
+    def count(self, path, seconds):
+        key = path.split('?')[0].rstrip('/').split('/')
+        key = '/'.join(k if not k.isdigit() else '{id}' for k in key)
+        with self.lock:
+            self.requests += 1
+            self.paths[key] = self.paths.get(key, 0) + 1
+            self.latencies.append(seconds)
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'paths': dict(self.paths), 'latencies': list(self.latencies)}
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.paths = {}
+            self.latencies = []
+
+    def owner_of(self, iid):
+        if self.other_owner_every and iid % self.other_owner_every == 0:
+            return 'someone_else', 3
+        return OWNER, 2
+
+    def image(self, iid):
+        owner, owner_id = self.owner_of(iid)
+        return {'@id': iid,
+                '@type': 'http://www.openmicroscopy.org/Schemas/OME/2016-06#Image',
+                'Name': 'image_%d.tif' % iid,
+                'Description': "synthetic image %d" % iid,
+                'omero:details': {'owner': {'@id': owner_id, 'UserName': owner}},
+                'Pixels': {'SizeX': 512, 'SizeY': 512, 'SizeZ': 1 + iid % 5, 'SizeC': 3, 'SizeT': 1,
+                           'Type': {'value': 'uint16'}}}
+
+    def dataset_images(self, did):
+        if did < 1 or did > self.datasets:
+            return range(0)
+        start = (did - 1) * self.per_dataset + 1
+        return range(start, min(start + self.per_dataset, self.images + 1))
+
+    def children(self, parent, count, pid):
+        # datasets of project pid or plates of screen pid (parent 1 of the projects holds all datasets)
+        if pid < 1 or pid > count:
+            return []
+        return [d for d in range(1, self.datasets + 1)
+                if (d - 1) % count == pid - 1 or (parent == 'projects' and pid == 1)]
+
+    def container(self, kind, cid):
+        return {'@id': cid, '@type': 'http://www.openmicroscopy.org/Schemas/OME/2016-06#' + kind,
+                'Name': '%s_%d' % (kind.lower(), cid)}
+
+    def well(self, iid):
+        return {'@id': iid, '@type': 'http://www.openmicroscopy.org/Schemas/OME/2016-06#Well',
+                'Column': iid % 12, 'Row': iid // 12,
+                'WellSamples': [{'@id': iid, 'Image': self.image(iid)}]}
+
+
+def make_handler(state, base):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, without TCP_NODELAY the body waits for the delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj, status=200, cookie=None):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if cookie:
+                self.send_header('Set-Cookie', 'sessionid=%s; Path=/' % cookie)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def page(self, items, query, render=None):
+            # one page of a listing of images, or of other objects built by render
+            limit = min(int(query.get('limit', [state.max_limit])[0]), state.max_limit)
+            offset = int(query.get('offset', [0])[0])
+            items = list(items)
+            data = [(render or state.image)(i) for i in items[offset:offset + limit]]
+            return {'data': data, 'meta': {'totalCount': len(items), 'limit': limit,
+                                           'offset': offset, 'maxLimit': state.max_limit}}
+
+        def handle_request(self):
+            start = time.perf_counter()
+            try:
+                self.answer()
+            finally:
+                state.count(self.path, time.perf_counter() - start)
+
+        def answer(self):
+            if self.path == '/stub/stats':
+                return self.send_json(state.stats())
+            if self.path == '/stub/reset':
+                state.reset()
+                return self.send_json({'success': True})
+            if state.latency:
+                time.sleep(state.latency)
+            if state.error_rate and random.random() < state.error_rate:
+                return self.send_json({'message': 'Internal Server Error'}, 500)
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [p for p in url.path.split('/') if p]
+            if parts == ['api']:
+                return self.send_json({'data': [{'version': '0', 'url:base': base + '/api/v0/'}]})
+            if parts == ['api', 'v0']:
+                v0 = base + '/api/v0/'
+                return self.send_json({
+                    'url:projects': v0 + 'm/projects/',
+                    'url:datasets': v0 + 'm/datasets/',
+                    'url:images': v0 + 'm/images/',
+                    'url:screens': v0 + 'm/screens/',
+                    'url:plates': v0 + 'm/plates/',
+                    'url:token': v0 + 'token/',
+                    'url:servers': v0 + 'servers/',
+                    'url:login': v0 + 'login/',
+                    'url:schema': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'})
+            if parts == ['api', 'v0', 'token']:
+                return self.send_json({'data': 'stub-csrf-token'})
+            if parts == ['api', 'v0', 'servers']:
+                return self.send_json({'data': [{'id': 1, 'host': 'localhost', 'port': 4064,
+                                                 'server': 'omero'}]})
+            if parts == ['api', 'v0', 'login']:
+                sessionid = '%032x' % random.getrandbits(128)
+                with state.lock:
+                    state.sessions.add(sessionid)
+                return self.send_json({'success': True, 'eventContext': {'userName': 'sudo'}},
+                                      cookie=sessionid)
+            if parts[:3] == ['api', 'v0', 'm']:
+                cookies = SimpleCookie(self.headers.get('Cookie', ''))
+                if 'sessionid' not in cookies or cookies['sessionid'].value not in state.sessions:
+                    return self.send_json({'message': 'Not logged in'}, 403)
+                rest = parts[3:]
+                if rest == ['images']:
+                    return self.send_json(self.page(range(1, state.images + 1), query))
+                if len(rest) == 2 and rest[0] == 'images':
+                    iid = int(rest[1])
+                    if iid < 1 or iid > state.images:
+                        return self.send_json({'message': 'Image %d not found' % iid}, 404)
+                    return self.send_json({'data': state.image(iid)})
+                if len(rest) == 3 and rest[0] == 'datasets' and rest[2] == 'images':
+                    return self.send_json(self.page(list(state.dataset_images(int(rest[1]))), query))
+                if len(rest) == 3 and rest[0] == 'projects' and rest[2] == 'datasets':
+                    datasets = state.children('projects', state.projects, int(rest[1]))
+                    return self.send_json(self.page(datasets, query, lambda d: state.container('Dataset', d)))
+                if len(rest) == 3 and rest[0] == 'screens' and rest[2] == 'plates':
+                    plates = state.children('screens', state.screens, int(rest[1]))
+                    return self.send_json(self.page(plates, query, lambda d: state.container('Plate', d)))
+                if len(rest) == 3 and rest[0] == 'plates' and rest[2] == 'wells':
+                    return self.send_json(self.page(list(state.dataset_images(int(rest[1]))), query, state.well))
+            return self.send_json({'message': 'not found'}, 404)
+
+        def do_GET(self):
+            if self.path.startswith('/stub/'):
+                return self.answer()
+            self.handle_request()
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            if self.path.startswith('/stub/'):
+                return self.answer()
+            self.handle_request()
+
+    return Handler
+
+
+def start_server(images=100, datasets=1, latency_ms=0.0, error_rate=0.0, max_limit=500,
+                 other_owner_every=0, port=0, projects=1, screens=1):
+    # start the stub server in a background thread, returns (server, state, base url)
+    state = StubState(images, datasets, latency_ms, error_rate, max_limit, other_owner_every, projects, screens)
+    server = ThreadingHTTPServer(('127.0.0.1', port), None)
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.RequestHandlerClass = make_handler(state, base)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, state, base
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="omero_stub_server")
+    parser.add_argument('--port', type=int, default=4080, help='0 = any free port')
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--datasets', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-limit', type=int, default=500)
+    parser.add_argument('--other-owner-every', type=int, default=0)
+    parser.add_argument('--projects', type=int, default=1)
+    parser.add_argument('--screens', type=int, default=1)
+    args = parser.parse_args()
+    server, state, base = start_server(args.images, args.datasets, args.latency_ms, args.error_rate,
+                                       args.max_limit, args.other_owner_every, args.port, args.projects,
+                                       args.screens)
+    print("OMERO stub server running at %s" % base, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
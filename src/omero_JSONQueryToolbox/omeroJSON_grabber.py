@@ -2,12 +2,31 @@
 from __future__ import print_function
 # for JSON API
 #from __future__ import print_function must be at beginning of file
-import argparse
+import time
+MODULE_START = time.perf_counter()
+import array
+import hashlib
+import hmac
+import importlib
 import os.path
 import re
-import requests
 import json
-import markdown
+import random
+import sys
+import threading
+import itertools
+import operator
+from collections import deque
+from collections.abc import ItemsView, Mapping
+import contextlib
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no file locking available (e.g. on Windows)
+    fcntl = None
+# The grabber is started for every evaluation of the ELN property, so heavier modules (requests,
+# aiohttp, sqlite3, ...) are imported by timed_import() on the code paths which use them.
 
 #####################################################################################################
 # This script returns the OMERO core metadata of given ID's of images (receive via OMERO JSON-API) or 
@@ -26,10 +45,25 @@ import markdown
 #
 # Input:
 # - Username in OMERO who owns the data
-# - Output file type (possible values: JSON, HTML, MD; optional)
+# - Output file types (possible values: JSON, HTML, MD, CSV, JSON.GZ, PARQUET; space or comma separated;
+#   optional)
 # - Number to identify created output file (e.g. timestamp or ELN-Object permId)
 # - Space separated list of OMERO IDs (e.g. 1 2 45), min. number of IDs = 1
-# - Type of the OMERO IDs (Possible values: IMAGES, DATASET)
+# - Type of the OMERO IDs (Possible values: IMAGES, DATASET, PROJECT, SCREEN, PLATE)
+# - Number of image requests sent to OMERO at the same time (optional, default: WORKERS)
+# - Engine for the requests to OMERO (possible values: threads, asyncio; optional, default: ENGINE)
+# - Number of images requested per page of a dataset listing (optional, default: PAGE_SIZE)
+# - Flag to fill the metadata of dataset images from the dataset listing (optional, default: BULK)
+# - Flags to bypass, refresh or purge the metadata cache METADATA_CACHE (optional)
+# - Flag to reuse the rows of the previous output and request only new IDs (optional), optionally
+#   refreshing all rows in the background
+# - Flag to run as daemon on DAEMON_HOST:DAEMON_PORT (optional), see GrabberService.answer() for the protocol
+# - Flag to print import and phase times to stderr, compared with STARTUP_TARGET_MS (optional)
+# - Flag to print phase times, request counts, cache hits and errors of the run to stderr or to
+#   METRICS_FILE (optional)
+# - Flag to print every row as JSON line as soon as it is fetched instead of the dictionary at the end (optional)
+# - Flag to print the metadata dictionary as JSON and all messages to stderr (optional)
+# - File to write the metadata dictionary to as JSON when the run is complete (optional)
 #
 # Output:
 # html, json or markdown file.
@@ -66,29 +100,267 @@ OMERO_WEB_HOST = 'https://my.omero.de'
 SAVE_OUTPUT = True
 # location for output file
 OUTPUT_PATH = "/path/to/output/dir"
+# number of requests (images and listing pages) sent to OMERO at the same time (1 = one after another)
+WORKERS = 8
+# engine used for the requests to OMERO: 'threads' or 'asyncio' (needs the aiohttp module)
+ENGINE = 'threads'
+# timeout in seconds for a single request to OMERO.web
+REQUEST_TIMEOUT = 30
+# requests per second to OMERO.web of all grabbers together (0 = no limit) and the number of
+# requests which may be sent at once after a quiet period
+RATE_LIMIT = 0
+RATE_BURST = 20
+# how often a failed GET request (no answer, timeout, status 429 or 5xx) is repeated, waiting a random
+# time of up to RETRY_BACKOFF * 2^attempt seconds before each repetition
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+# after BREAKER_FAILURES failed requests in a row, OMERO.web is not contacted for BREAKER_COOLDOWN
+# seconds; meanwhile the grabber answers with cached rows or placeholders
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+# file for the state of rate limiter and circuit breaker, shared by all grabbers ('' = per process)
+GUARD_STATE = ''
+# number of images requested per page of a dataset listing (OMERO.web caps it at its maxLimit)
+PAGE_SIZE = 500
+# fill the metadata of dataset images directly from the dataset listing instead of requesting
+# every image again (images are only requested if the listing lacks fields)
+BULK = False
+# file to keep the OMERO session between runs of the grabber
+# ('' = log in on every run)
+SESSION_CACHE = ''
+# directory for the lock files which let concurrent grabbers share the requests for the same IDs
+# ('' = every grabber requests its IDs itself)
+SINGLEFLIGHT_DIR = ''
+# maximum time in seconds to wait for another grabber requesting the same IDs
+SINGLEFLIGHT_WAIT = 60
+# maximum age in seconds of a cached OMERO session
+SESSION_TTL = 3600
+# cold start budget in milliseconds, --profile-startup reports whether a run stayed below it
+STARTUP_TARGET_MS = 500
+# default of --deadline-ms: milliseconds after which the grabber answers with the images fetched
+# so far and "pending" rows for the others (0 = wait for all images)
+DEADLINE_MS = 0
+# file to append the metrics of every run with --metrics to ('' = print them to stderr)
+METRICS_FILE = ''
+# rows per chunk written to Parquet output files (needs pyarrow)
+OUTPUT_CHUNK_ROWS = 10000
+# SQLite file caching the image metadata between runs ('' = no cache)
+METADATA_CACHE = ''
+# maximum age in seconds of a cached image
+METADATA_CACHE_TTL = 86400
+# maximum number of cached images, the least recently used ones are removed first
+METADATA_CACHE_SIZE = 100000
+# seconds to remember missing images and datasets and images of other owners (negative cache)
+NEGATIVE_CACHE_TTL = 300
+# address of the grabber daemon (python3 omeroJSON_grabber.py --serve), keep it on the loopback interface
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 4091
+# secret the converter has to send with every daemon request (required for --serve: every local account
+# can connect to the daemon, which reads the metadata of all users with the sudo session)
+DAEMON_SECRET = ''
+# maximum size in bytes of a daemon request
+DAEMON_MAX_REQUEST = 1048576
 #####################################################################################################
 #####################################################################################################
 # name of session server
 SERVER_NAME = 'omero'
+# reasons of failed lookups in the negative cache
+MISSING_IMAGE = 'image does not exist'
+MISSING_DATASET = 'dataset does not exist'
+NOT_OWNER = 'not the image owner'
+REQUEST_FAILED = 'request failed'
+INVALID_RESPONSE = 'invalid response'
+LOGIN_FAILED = 'login failed'
+OMERO_UNAVAILABLE = 'OMERO not available'
+# container ID types: name -> (row ID of an empty or missing container, listing steps). Every step is the
+# url key of the containers and the path of the listing of their children, the last step lists the images
+# (for plates the wells, whose samples hold the images)
+CONTAINER_TYPES = {'dataset': (-2, [('url:datasets', 'images')]),
+                   'project': (-3, [('url:projects', 'datasets'), ('url:datasets', 'images')]),
+                   'screen': (-4, [('url:screens', 'plates'), ('url:plates', 'wells')]),
+                   'plate': (-5, [('url:plates', 'wells')])}
+# row ID of an empty or missing container -> container type
+MISSING_CONTAINERS = {missing: name for name, (missing, steps) in CONTAINER_TYPES.items()}
+# image object of the row of a container whose listing could not be read completely
+FAILED_LISTING = {}
+# descriptions of placeholder rows, which are never reused by an incremental run (see reusable_row())
+PENDING_DESCRIPTION = "The metadata is still being loaded from OMERO, it will be shown on the next evaluation"
+UNAVAILABLE_DESCRIPTION = "OMERO is not available at the moment, the metadata will be shown later"
+# descriptions of the rows of missing images and images of other owners, which are reused like fetched rows
+MISSING_IMAGE_DESCRIPTION = "This image does not exist in the OMERO database"
+NOT_OWNER_DESCRIPTION = "This ELN User is not the image owner: metadata access denied"
+# rate limiter and circuit breaker of this process, see omero_guard()
+GUARD = None
 #####################################################################################################
 
-def markdown_table(metadata_dict, headers, mdfname):
-    rows = []
-    # specify width of column
-    col_w = 20
-    # build markdown table
-    # header
-    rows.append('|'.join(s.center(col_w) for s in headers))
-    # separator
-    rows.append('|'.join('-' * col_w for x in range(len(headers))))
-    # build body
-    for i in metadata_dict.values():
-        # put line break in string if longer than 18 chars
-        rows.append('|'.join('<br>'.join(str(v)[i:i+col_w-2] for i in range(0, len(str(v)), col_w-2)).center(col_w)
-                             for k, v in i.items() if k in headers))
-    with open(mdfname, 'w') as f:
-        for row in rows:
-            print("|"+row+"|", file=f)
+# seconds spent for lazy imports and for the phases of a run, see --profile-startup
+IMPORT_TIMES = {}
+PHASE_TIMES = {}
+# phase -> [number of running instances, start of the time they overlap], see timed_phase()
+RUNNING_PHASES = {}
+PHASES_LOCK = threading.Lock()
+
+
+def timed_import(name):
+    # imports a module on first use and records how long it took
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES[name] = time.perf_counter() - start
+    return module
+
+
+@contextmanager
+def timed_phase(name):
+    # records the wall time of a phase of the run (adds up if the phase runs several times). Instances
+    # running at the same time in several threads, like listing pages, count once for the time they overlap.
+    with PHASES_LOCK:
+        running = RUNNING_PHASES.setdefault(name, [0, 0.0])
+        if running[0] == 0:
+            running[1] = time.perf_counter()
+        running[0] += 1
+    try:
+        yield
+    finally:
+        with PHASES_LOCK:
+            running[0] -= 1
+            if running[0] == 0:
+                PHASE_TIMES[name] = PHASE_TIMES.get(name, 0.0) + time.perf_counter() - running[1]
+
+
+# counters of the run (HTTP requests, cache hits, errors per reason), see --metrics
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+
+def count_metric(name, key=None, n=1):
+    # increments the counter 'name', or its entry 'key' if the counter is kept per key
+    with METRICS_LOCK:
+        if key is None:
+            METRICS[name] = METRICS.get(name, 0) + n
+        else:
+            counter = METRICS.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + n
+
+
+def count_response(r, *args, **kwargs):
+    # response hook of the requests sessions
+    count_metric('http_requests')
+    count_metric('http_status', str(r.status_code))
+    count_metric('http_bytes', n=len(r.content))
+
+
+def run_metrics(engine, idtype, ids, rows):
+    # returns the metrics of the run as dictionary
+    with METRICS_LOCK:
+        counters = json.loads(json.dumps(METRICS))
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'engine': engine,
+            'idtype': idtype,
+            'ids': ids,
+            'rows': rows,
+            'phases_ms': {name: round(t * 1000.0, 2) for name, t in PHASE_TIMES.items()},
+            'total_ms': round((time.perf_counter() - MODULE_START) * 1000.0, 2),
+            'http': {'requests': counters.get('http_requests', 0),
+                     'bytes': counters.get('http_bytes', 0),
+                     'status': counters.get('http_status', {})},
+            'cache': counters.get('cache', {}),
+            'errors': counters.get('errors', {}),
+            'pending': counters.get('pending', 0)}
+
+
+def write_metrics(metrics):
+    # appends the metrics as one JSON line to METRICS_FILE, prints them to stderr if it is not set
+    line = json.dumps(metrics)
+    if not METRICS_FILE:
+        print(line, file=sys.stderr)
+        return
+    try:
+        with open(METRICS_FILE, 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        print("Warning: cannot write metrics file %s: %s" % (METRICS_FILE, str(e)), file=sys.stderr)
+
+
+def import_async_engine():
+    # imports asyncio and aiohttp for the asyncio engine, False if aiohttp is not installed
+    global asyncio, aiohttp, URL
+    try:
+        asyncio = timed_import('asyncio')
+        aiohttp = timed_import('aiohttp')
+        URL = timed_import('yarl').URL
+    except ImportError:
+        return False
+    return True
+
+
+def import_parquet():
+    # imports pyarrow for the Parquet output, False if pyarrow is not installed
+    try:
+        timed_import('pyarrow')
+        timed_import('pyarrow.parquet')
+    except ImportError:
+        return False
+    return True
+
+
+def startup_profile():
+    # returns the recorded import and phase times in milliseconds
+    ms = lambda seconds: round(seconds * 1000.0, 2)
+    total = time.perf_counter() - MODULE_START
+    return {'module_import_ms': ms(MODULE_LOADED - MODULE_START),
+            'imports_ms': {name: ms(t) for name, t in IMPORT_TIMES.items()},
+            'phases_ms': {name: ms(t) for name, t in PHASE_TIMES.items()},
+            'total_ms': ms(total),
+            'target_ms': STARTUP_TARGET_MS,
+            'over_target': ms(total) > STARTUP_TARGET_MS}
+
+
+def escape_markdown(value):
+    # escapes a table cell for Markdown: pipes would end the cell, line breaks the row
+    html = timed_import('html')
+    return html.escape(str(value), quote=False).replace('|', '\\|').replace('\r\n', '<br>').replace('\n', '<br>')
+
+
+# width of the columns of the Markdown table
+MD_COLUMN_WIDTH = 20
+
+
+def table_head(headers, fmt):
+    # returns the lines of a Markdown ('md') or HTML ('html') table before the first row
+    if fmt == 'html':
+        html = timed_import('html')
+        return ['<table>', '<thead>',
+                '<tr>' + ''.join('<th>%s</th>' % html.escape(str(h)) for h in headers) + '</tr>',
+                '</thead>', '<tbody>']
+    # header and separator
+    return ['|' + '|'.join(escape_markdown(h).center(MD_COLUMN_WIDTH) for h in headers) + '|',
+            '|' + '|'.join('-' * MD_COLUMN_WIDTH for h in headers) + '|']
+
+
+def table_row(row, headers, fmt):
+    # returns the table line of one metadata sub-dictionary
+    if fmt == 'html':
+        html = timed_import('html')
+        return '<tr>' + ''.join('<td>%s</td>' % html.escape(str(row.get(h, '-'))) for h in headers) + '</tr>'
+    return '|' + '|'.join(escape_markdown(row.get(h, '-')).center(MD_COLUMN_WIDTH) for h in headers) + '|'
+
+
+def table_foot(fmt):
+    # returns the lines of a table after the last row
+    return ['</tbody>', '</table>'] if fmt == 'html' else []
+
+
+def render_table(metadata_dict, headers, fmt):
+    # renders the metadata dictionary as Markdown ('md') or HTML ('html') table in one pass,
+    # returns the table as string
+    rows = table_head(headers, fmt)
+    rows.extend(table_row(row, headers, fmt) for row in metadata_dict.values())
+    rows.extend(table_foot(fmt))
+    rows.append('')
+    return '\n'.join(rows)
 
 
 def check_dir_permissions():
@@ -98,43 +370,450 @@ def check_dir_permissions():
         raise FileNotFoundError("Error: no such file or directory" + OUTPUT_PATH)
 
 
+@contextmanager
+def atomic_file(fname, mode='w'):
+    # opens a temporary file next to fname and renames it to fname once it is closed,
+    # so readers never see a half-written file
+    tempfile = timed_import('tempfile')
+    fd, tmpfile = tempfile.mkstemp(prefix='.' + os.path.basename(fname), dir=os.path.dirname(fname) or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, fname)
+    except BaseException:
+        os.remove(tmpfile)
+        raise
+
+
+def write_atomic(fname, content):
+    # writes content to fname via atomic_file()
+    with atomic_file(fname) as f:
+        f.write(content)
+
+
+def fill_cache_later(owner, ident, IdList, engine=ENGINE, workers=WORKERS):
+    # fetches image IDs into the metadata cache in a background grabber
+    spawn_background_refresh(['-o', owner, '-n', "%s" % ident, '-d', 'IMAGES', '--fill-cache',
+                              '--engine', engine, '--workers', str(workers), '-i']
+                             + ["%s" % ID for ID in dict.fromkeys(IdList)])
+
+
+def load_previous_output(ident):
+    # returns the metadata dictionary of the previous JSON output omero_<ident>.json, None if there is none
+    if ident is None:
+        return None
+    try:
+        with open(os.path.join(OUTPUT_PATH, f"omero_{ident}.json"), 'r') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return previous if isinstance(previous, dict) else None
+
+
+def spawn_background_refresh(argv):
+    # starts the grabber detached from this process with argv to request all IDs again,
+    # it rewrites the output files when it is done
+    subprocess = timed_import('subprocess')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     close_fds=True, start_new_session=True)
+
+
+def write_rows(metadata, headers, f, fmt):
+    # writes the rows one by one with StreamingFile
+    out = StreamingFile(f, fmt, headers)
+    for key, row in metadata.items():
+        out.row(key, row)
+    out.close()
+
+
+def write_json(metadata, headers, f):
+    # the same file as json.dump(metadata, f, indent=4), written row by row
+    write_rows(metadata, headers, f, 'json')
+
+
+def write_json_gz(metadata, headers, f):
+    write_rows(metadata, headers, f, 'json.gz')
+
+
+def write_csv(metadata, headers, f):
+    write_rows(metadata, headers, f, 'csv')
+
+
+def write_parquet(metadata, headers, f):
+    write_rows(metadata, headers, f, 'parquet')
+
+
+def write_md(metadata, headers, f):
+    f.write(render_table(metadata, headers, 'md'))
+
+
+def write_html(metadata, headers, f):
+    f.write(render_table(metadata, headers, 'html'))
+
+
+# output formats: name -> (file extension, function writing the metadata to an open file, file mode)
+OUTPUT_FORMATS = {'json': ('json', write_json, 'w'),
+                  'md': ('md', write_md, 'w'),
+                  'html': ('html', write_html, 'w'),
+                  'csv': ('csv', write_csv, 'w'),
+                  'json.gz': ('json.gz', write_json_gz, 'wb'),
+                  'parquet': ('parquet', write_parquet, 'wb')}
+# other names accepted for the output formats
+FORMAT_ALIASES = {'markdown': 'md', 'htm': 'html', 'gz': 'json.gz', 'jsongz': 'json.gz', 'pq': 'parquet'}
+
+
+def parse_formats(ftypes):
+    # returns the list of requested output formats from --filetype values, which may also be
+    # comma separated (e.g. "json,html"); unknown names are ignored, default is ['json']
+    if isinstance(ftypes, str):
+        ftypes = [ftypes]
+    formats = []
+    for value in ftypes or []:
+        for name in re.split(r'[,\s]+', value.lower()):
+            name = FORMAT_ALIASES.get(name, name)
+            if name in OUTPUT_FORMATS and name not in formats:
+                formats.append(name)
+    return formats or ['json']
+
+
 def save_output(metadata, headers, ident, ftypeList):
     # check permissions of directory OUTPUT_PATH
     check_dir_permissions()
-    # save metadata dictionary as json, markdown or html file
+    # save metadata dictionary once per requested format; every file is written to a temporary
+    # file and renamed, several formats are written in parallel
     fName = os.path.join(OUTPUT_PATH, f"omero_{ident}")
-    for i in ftypeList:
-        if re.search('json', i, re.IGNORECASE):
-            json_metadata = json.dumps(metadata)
-            jsonfile = f"{fName}.json"
-            with open(jsonfile, "w") as f:
-                json.dump(metadata, f, indent=4)
-        if re.search('md', i, re.IGNORECASE):
-            mdfile = f"{fName}.md"
-            markdown_table(metadata, headers, mdfile)
-        if re.search('html', i, re.IGNORECASE):
-            mdfile = f"{fName}.md"
-            markdown_table(metadata, headers, mdfile)
-            with open(mdfile, 'r') as f:
-                markdown_string = f.read()
-            html_table = markdown.markdown(markdown_string)
-            htmlfile = f"{fName}.html"
-            with open(htmlfile, 'w') as f:
-                f.write(html_table)
-            if os.path.isfile(mdfile):
-                os.remove(mdfile)
+
+    def write(fmt):
+        extension, writer, mode = OUTPUT_FORMATS[fmt]
+        with atomic_file(f"{fName}.{extension}", mode) as f:
+            writer(metadata, headers, f)
+
+    formats = parse_formats(ftypeList)
+    if len(formats) == 1:
+        write(formats[0])
+    else:
+        ThreadPoolExecutor = timed_import('concurrent.futures').ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(formats)) as executor:
+            # list() re-raises the first error of a writer
+            list(executor.map(write, formats))
+
+
+def integer_cell(value):
+    # value of an integer column as int, None if there is none ("-"): rows of missing, pending or
+    # unavailable images have the given ID, which is a string of digits
+    if type(value) is int:
+        return value
+    if isinstance(value, str) and re.fullmatch(r'-?[0-9]+', value):
+        return int(value)
+    return None
+
+
+class StreamingFile:
+    # writes the rows of one output format to its file as they arrive, so the memory does not grow
+    # with the number of rows; headers are taken from the first row if they are not given
+    def __init__(self, f, fmt, headers=None):
+        self.f = f
+        self.fmt = fmt
+        self.headers = list(headers) if headers else None
+        self.started = False
+        if fmt == 'json.gz':
+            # JSON file as for 'json', gzip-compressed
+            gzip = timed_import('gzip')
+            io = timed_import('io')
+            self.f = io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='wb'), encoding='utf-8')
+        elif fmt == 'csv':
+            self.writer = timed_import('csv').writer(f, lineterminator='\n')
+        elif fmt == 'parquet':
+            self.chunk = []
+            self.writer = None
+
+    def start(self, row):
+        # writes what comes before the first row
+        self.started = True
+        if self.headers is None:
+            self.headers = list(row.keys()) if row is not None else []
+        if self.fmt in ('md', 'html'):
+            self.f.write(''.join(line + '\n' for line in table_head(self.headers, self.fmt)))
+        elif self.fmt == 'csv':
+            self.writer.writerow(self.headers)
+
+    def row(self, key, row):
+        if self.fmt in ('json', 'json.gz'):
+            # the entry as json.dump(metadata, f, indent=4) writes it
+            entry = json.dumps({key: row}, indent=4)[2:-2]
+            self.f.write((',\n' if self.started else '{\n') + entry)
+            self.started = True
+            return
+        if not self.started:
+            self.start(row)
+        if self.fmt == 'csv':
+            self.writer.writerow([row.get(h, '-') for h in self.headers])
+        elif self.fmt == 'parquet':
+            self.chunk.append(row)
+            if len(self.chunk) >= OUTPUT_CHUNK_ROWS:
+                self.write_chunk()
+        else:
+            self.f.write(table_row(row, self.headers, self.fmt) + '\n')
+
+    def write_chunk(self):
+        # writes the collected rows as one row group, with integer columns as int64 and "-" as null
+        pa = timed_import('pyarrow')
+        if self.writer is None:
+            headers = self.headers or list(MetadataTable.HEADERS)
+            schema = pa.schema([(h, pa.int64() if h in MetadataTable.INTEGER_HEADERS else pa.string())
+                                for h in headers])
+            self.writer = timed_import('pyarrow.parquet').ParquetWriter(self.f, schema)
+        columns = {}
+        for field in self.writer.schema:
+            values = [row.get(field.name, '-') for row in self.chunk]
+            if pa.types.is_integer(field.type):
+                columns[field.name] = [integer_cell(v) for v in values]
             else:
-                print("Error: %s file not found" % mdfile)
+                columns[field.name] = [None if v == '-' else str(v) for v in values]
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.writer.schema))
+        self.chunk = []
+
+    def close(self):
+        if self.fmt in ('json', 'json.gz'):
+            self.f.write('\n}' if self.started else '{}')
+            if self.fmt == 'json.gz':
+                # writes the end of the gzip stream, f itself stays open
+                self.f.close()
+            return
+        if not self.started:
+            self.start(None)
+        if self.fmt == 'parquet':
+            if self.chunk or self.writer is None:
+                self.write_chunk()
+            self.writer.close()
+        else:
+            self.f.write(''.join(line + '\n' for line in table_foot(self.fmt)))
+
+
+class MetadataStream:
+    # stands in for the metadata dictionary in --stream mode: every row is written as one JSON line
+    # {"<ID>": {...}} to 'out' and to the output files as soon as it is set, rows are not kept
+    def __init__(self, out, ident=None, ftypeList=None):
+        self.out = out
+        self.seen = set()
+        self.files = []
+        self.stack = contextlib.ExitStack()
+        if ident is not None:
+            check_dir_permissions()
+            fName = os.path.join(OUTPUT_PATH, f"omero_{ident}")
+            try:
+                for fmt in parse_formats(ftypeList):
+                    extension, writer, mode = OUTPUT_FORMATS[fmt]
+                    f = self.stack.enter_context(atomic_file(f"{fName}.{extension}", mode))
+                    self.files.append(StreamingFile(f, fmt))
+            except Exception as e:
+                self.close(e)
+                raise
+
+    def __setitem__(self, key, row):
+        # like the dictionary, an ID keeps the position of its first row
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        self.out.write(json.dumps({key: row}) + '\n')
+        self.out.flush()
+        for f in self.files:
+            f.row(key, row)
+
+    def update(self, metadata):
+        for key, row in metadata.items():
+            self[key] = row
+
+    def __len__(self):
+        return len(self.seen)
+
+    def close(self, error=None):
+        # completes the output files, or removes them after an error
+        if error is None:
+            for f in self.files:
+                f.close()
+            self.stack.close()
         else:
-            # if none of the types is selected, choose json
-            json_metadata = json.dumps(metadata)
-            jsonfile = f"{fName}.json"
-            with open(jsonfile, "w") as f:
-                json.dump(metadata, f, indent=4)
+            self.stack.__exit__(type(error), error, error.__traceback__)
+
+
+class MetadataTable(Mapping):
+    # Columnar store of the metadata rows with the fixed schema of the sub-dictionaries: one column per
+    # header, the integer columns (ID, SizeX, ...) are arrays. It behaves like the metadata dictionary
+    # {ID: sub-dictionary}, the sub-dictionaries are only built when they are accessed.
+    # New rows are collected as tuples and moved into the columns CHUNK rows at a time. Cells of an integer
+    # column which are no integers ("-", the given ID of error rows) are MISSING in the array, the values
+    # other than "-" are kept in 'other', so the column stays an array.
+    HEADERS = ('Name', 'ID', 'Username', 'Description', 'SizeX', 'SizeY', 'Pixel Type', 'SizeZ', 'SizeC', 'SizeT')
+    INTEGER_HEADERS = ('ID', 'SizeX', 'SizeY', 'SizeZ', 'SizeC', 'SizeT')
+    # columns with few distinct values, every value is kept once
+    SHARED_HEADERS = ('Username', 'Pixel Type')
+    # stands for "-" (or a value in 'other') in an integer column
+    MISSING = -2 ** 63
+    CHUNK = 4096
+
+    def __init__(self, metadata=None):
+        self.headers = list(self.HEADERS)
+        self.index = {h: i for i, h in enumerate(self.headers)}
+        self.columns = [array.array('q') if h in self.INTEGER_HEADERS else [] for h in self.headers]
+        self.other = {self.index[h]: {} for h in self.INTEGER_HEADERS}
+        self.shared = {self.index[h]: {} for h in self.SHARED_HEADERS}
+        self.row_values = operator.itemgetter(*self.headers)
+        self.rows = []
+        self.ids = []
+        self.positions = {}
+        if metadata:
+            self.update(metadata)
+
+    def compact(self):
+        # moves the collected rows into the columns
+        if not self.rows:
+            return
+        start = len(self.ids) - len(self.rows)
+        for column, values in enumerate(zip(*self.rows)):
+            if column in self.other:
+                self.extend_integers(column, values, start)
+            elif column in self.shared:
+                setdefault = self.shared[column].setdefault
+                self.columns[column].extend([setdefault(v, v) if type(v) is str else v for v in values])
+            else:
+                self.columns[column].extend(values)
+        self.rows = []
+
+    def extend_integers(self, column, values, start):
+        # appends the values of rows start, start + 1, ... to an integer column
+        values = list(values)
+        odd = [i for i, v in enumerate(values) if type(v) is not int]
+        try:
+            self.columns[column].extend(array.array('q', self.without(column, values, odd, start)))
+        except OverflowError:
+            odd = [i for i, v in enumerate(values) if not self.MISSING <= v < 2 ** 63]
+            self.columns[column].extend(array.array('q', self.without(column, values, odd, start)))
+
+    def without(self, column, values, odd, start):
+        # replaces the values at the positions odd by MISSING, keeps them in 'other' unless they are "-"
+        for i in odd:
+            if values[i] != '-':
+                self.other[column][start + i] = values[i]
+            values[i] = self.MISSING
+        return values
+
+    def cell(self, column, position):
+        value = self.columns[column][position]
+        if value == self.MISSING and column in self.other:
+            return self.other[column].get(position, '-')
+        return value
+
+    def store(self, column, value, position):
+        if column in self.other:
+            self.other[column].pop(position, None)
+            if type(value) is not int or not self.MISSING < value < 2 ** 63:
+                if value != '-':
+                    self.other[column][position] = value
+                value = self.MISSING
+        elif column in self.shared and isinstance(value, str):
+            value = self.shared[column].setdefault(value, value)
+        self.columns[column][position] = value
+
+    def __setitem__(self, key, row):
+        try:
+            values = self.row_values(row)
+        except KeyError:
+            values = tuple(row.get(header, '-') for header in self.headers)
+        position = self.positions.get(key)
+        if position is None:
+            self.positions[key] = len(self.ids)
+            self.ids.append(key)
+            self.rows.append(values)
+            if len(self.rows) >= self.CHUNK:
+                self.compact()
+            return
+        # like the dictionary, an ID keeps its position if it is set again
+        self.compact()
+        for column, value in enumerate(values):
+            self.store(column, value, position)
+
+    def update(self, metadata):
+        for key, row in metadata.items():
+            self[key] = row
+
+    def __getitem__(self, key):
+        position = self.positions[key]
+        self.compact()
+        return {header: self.cell(column, position) for column, header in enumerate(self.headers)}
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def items(self):
+        return MetadataItems(self)
+
+    def values_of(self, column):
+        # returns the values of one column as list, with "-" and the other values of integer columns
+        values = self.columns[column]
+        if column not in self.other:
+            return list(values)
+        if not values.count(self.MISSING):
+            return values.tolist()
+        other = self.other[column]
+        return [other.get(i, '-') if v == self.MISSING else v for i, v in enumerate(values)]
+
+    def column(self, header):
+        # returns the values of one column, "-" for missing integers
+        self.compact()
+        return self.values_of(self.index[header])
+
+    def iter_values(self):
+        # yields the values of every row in the order of the headers (as tuple)
+        self.compact()
+        return zip(*[self.values_of(column) for column in range(len(self.headers))])
+
+    def iter_rows(self):
+        # yields (ID, sub-dictionary) of every row, built column by column
+        headers = self.headers
+        return ((key, dict(zip(headers, values))) for key, values in zip(self.ids, self.iter_values()))
+
+
+class MetadataItems(ItemsView):
+    # items() of a MetadataTable, iterated without looking up every row
+    def __iter__(self):
+        return self._mapping.iter_rows()
+
+
+def iter_json(metadata, layout='dict', chunk=1000):
+    # yields the metadata dictionary or MetadataTable as JSON in pieces of up to 'chunk' rows: 'dict' gives
+    # the text of json.dumps(metadata), 'spreadsheet' gives {"headers": [...], "data": [[...], ...]} as used
+    # by the openBIS Spreadsheet of dict2openBIS_converter.jy
+    if layout == 'spreadsheet':
+        table = metadata if isinstance(metadata, MetadataTable) else MetadataTable(metadata)
+        yield '{"headers": %s, "data": [' % json.dumps(table.headers)
+        rows = table.iter_values()
+        for i, values in enumerate(iter(lambda: list(itertools.islice(rows, chunk)), [])):
+            yield (', ' if i else '') + json.dumps(values)[1:-1]
+        yield ']}'
+        return
+    yield '{'
+    items = iter(metadata.items())
+    for i, rows in enumerate(iter(lambda: dict(itertools.islice(items, chunk)), {})):
+        yield (', ' if i else '') + json.dumps(rows)[1:-1]
+    yield '}'
 
 
 def get_headers(metadata):
     #print("get_headers()")
+    if isinstance(metadata, MetadataTable):
+        return list(metadata.headers)
     keys = []
     for i in metadata:
         keys = metadata[i].keys()
@@ -166,121 +845,967 @@ def fill_dict_default(mdict,ID):
     fill_dict(mdict, ID, 'SizeT', "-")
 
 
-def get_core_metadata(openBISUser, IdList, idtype, metadata, images_url, datasets_url, session):
-    # finale image ID Liste:
-    imageIDsList = []
-    # if dataset: get ImageIds, put them in image ID list
-    if re.match(idtype, "Dataset", re.IGNORECASE):
-        for datasetId in IdList:
-            dsUrl = datasets_url + datasetId + "/images/"
+def default_metadata(ID, rowID, description):
+    # returns a metadata sub-dictionary with placeholders, the given ID and a description
+    row = {"%s" % ID: {}}
+    fill_dict_default(row, ID)
+    fill_dict(row, ID, 'ID', rowID)
+    fill_dict(row, ID, 'Description', description)
+    return row["%s" % ID]
+
+
+def unavailable_metadata(ID, rowID=None):
+    # returns the placeholder of an image (or dataset) while OMERO.web is unavailable
+    count_metric('errors', OMERO_UNAVAILABLE)
+    return default_metadata(ID, ID if rowID is None else rowID, UNAVAILABLE_DESCRIPTION)
+
+
+def parse_image_metadata(openBISUser, ID, imgjson):
+    # parses the JSON API response of one image into its metadata sub-dictionary
+    row = {"%s" % ID: {}}
+    # if image exists in OMERO database
+    try:
+        imgjson['data']['@id']
+        # if the ELN user is the image owner & allowed to get the image metadata
+        if imgjson['data']['omero:details']['owner']['UserName'] == openBISUser:
+            # parse information from json to our metadata dict
+                fill_dict(row, ID, 'Name', imgjson['data']['Name'])
+                fill_dict(row, ID, 'ID', imgjson['data']['@id'])
+                fill_dict(row, ID, 'Username', imgjson['data']['omero:details']['owner']['UserName'])
+                fill_dict(row, ID, 'Description', imgjson['data']['Description'])
+                fill_dict(row, ID, 'SizeX', imgjson['data']['Pixels']['SizeX'])
+                fill_dict(row, ID, 'SizeY', imgjson['data']['Pixels']['SizeY'])
+                fill_dict(row, ID, 'Pixel Type', imgjson['data']['Pixels']['Type']['value'])
+                fill_dict(row, ID, 'SizeZ', imgjson['data']['Pixels']['SizeZ'])
+                fill_dict(row, ID, 'SizeC', imgjson['data']['Pixels']['SizeC'])
+                fill_dict(row, ID, 'SizeT', imgjson['data']['Pixels']['SizeT'])
+        else:
+            # if the ELN user is not the image owner & not allowed to get the image metadata,
+            # give this info as descr and the ID of the image
+            count_metric('errors', NOT_OWNER)
+            return default_metadata(ID, imgjson['data']['@id'], NOT_OWNER_DESCRIPTION)
+
+    except Exception as e:
+        # cannot get image json for image ID
+        #print("Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
+        return default_metadata(ID, ID, "Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
+
+    return row["%s" % ID]
+
+
+def missing_container_metadata(ID):
+    # returns the row of a given dataset, project, screen or plate which is empty or does not exist
+    kind = MISSING_CONTAINERS[ID]
+    count_metric('errors', MISSING_DATASET if kind == 'dataset' else '%s does not exist' % kind)
+    return default_metadata(ID, -1, "One given ID does not correspond to an existing OMERO %s" % kind)
+
+
+def image_metadata_from_response(openBISUser, ID, imgjson, status, cache=None):
+    # parses the JSON API response of one image and puts the image into the cache,
+    # missing images and images of other owners also into the negative cache
+    if status == 404:
+        row = default_metadata(ID, ID, MISSING_IMAGE_DESCRIPTION)
+    else:
+        row = parse_image_metadata(openBISUser, ID, imgjson)
+    try:
+        imgjson['data']['@id']
+    except Exception as e:
+        count_metric('errors', MISSING_IMAGE if status == 404 else INVALID_RESPONSE)
+    if cache is not None:
+        if status == 404:
+            cache.store_missing('image', ID, '', MISSING_IMAGE, row)
+            return row
+        cache.store(imgjson.get('data'))
+        try:
+            owner = imgjson['data']['omero:details']['owner']['UserName']
+        except (KeyError, TypeError):
+            owner = None
+        if owner is not None and owner != openBISUser:
+            cache.store_missing('image', ID, openBISUser, NOT_OWNER, row)
+    return row
+
+
+def get_image_metadata(openBISUser, ID, images_url, session, cache=None):
+    # returns the core metadata of a single image ID as sub-dictionary
+    # handle not existing dataset (or other container)
+    if ID in MISSING_CONTAINERS:
+        return missing_container_metadata(ID)
+    # dataset exists or instead image IDs were given
+    r = None
+    try:
+        r = omero_request(session, 'GET', images_url + str(ID) + '/')
+        if not response_ok(r.status_code):
+            # still failing after the retries, the image is requested again later
+            return unavailable_metadata(ID)
+        imgjson = r.json()
+    except OmeroUnavailable as e:
+        return unavailable_metadata(ID)
+    except Exception as e:
+        if r is None or r.status_code != 404:
+            # the request failed, the image is requested again by the next run
+            count_metric('errors', REQUEST_FAILED)
+            return default_metadata(ID, ID, "Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
+        # this image does not exist in the OMERO database
+        row = default_metadata(ID, ID, MISSING_IMAGE_DESCRIPTION)
+        count_metric('errors', MISSING_IMAGE)
+        if cache is not None:
+            cache.store_missing('image', ID, '', MISSING_IMAGE, row)
+        return row
+
+    return image_metadata_from_response(openBISUser, ID, imgjson, r.status_code, cache)
+
+
+def listing_params(page_size, offset):
+    # query of a listing page
+    return {'limit': page_size, 'offset': offset}
+
+
+def container_type(idtype):
+    # returns the container type ('dataset', 'project', 'screen' or 'plate') of an ID type given
+    # as e.g. DATASET or Plates, None for images
+    for name in CONTAINER_TYPES:
+        if re.match(idtype, name + 's', re.IGNORECASE):
+            return name
+    return None
+
+
+def listing_url(urls, step, ID):
+    # url of the child listing of container ID in one listing step (see CONTAINER_TYPES)
+    url_key, path = step
+    return urls[url_key] + str(ID) + '/' + path + '/'
+
+
+def listed_images(path, obj):
+    # image objects of one object of a child listing: the image itself or the images of a well
+    if path == 'wells':
+        return [sample['Image'] for sample in obj.get('WellSamples') or [] if 'Image' in sample]
+    return [obj]
+
+
+def get_listing_page(session, url, page_size=PAGE_SIZE, offset=0, deadline=None):
+    # returns the objects of one page of a listing and the number of objects of the whole listing
+    with timed_phase('datasets'):
+        r = omero_request(session, 'GET', url, deadline=deadline, params=listing_params(page_size, offset))
+        r.raise_for_status()
+        listing = r.json()
+    return listing['data'], listing['meta']['totalCount']
+
+
+def listing_failed(url, e):
+    # reports a listing page which cannot be read, the listing of its container is incomplete
+    # (while OMERO.web is unavailable its placeholder row says so)
+    if isinstance(e, OmeroUnavailable):
+        return
+    print("Error: cannot read the listing %s: %s" % (url, str(e)), file=sys.stderr)
+
+
+def iter_listing(parents, url_of, session, executor, workers=WORKERS, page_size=PAGE_SIZE, deadline=None):
+    # yields (parent, objects of one page of its child listing) in the order of parents, (parent, None)
+    # if a page of the listing cannot be read (no more pages of it follow). The first pages of the next
+    # 'workers' parents and the further pages of the current parent are requested at the same time, so only
+    # about 'workers' pages are held. The pages are requested in the threads of executor, which the image
+    # requests share (see get_core_metadata()). OMERO.web returns at most its maxLimit objects per page.
+    parents = iter(parents)
+
+    def submit(parent, offset=0):
+        return executor.submit(get_listing_page, session, url_of(parent), page_size, offset, deadline)
+
+    ahead = deque((parent, submit(parent)) for parent in itertools.islice(parents, workers))
+    while ahead:
+        parent, future = ahead.popleft()
+        ahead.extend((parent, submit(parent)) for parent in itertools.islice(parents, 1))
+        try:
+            page, total = future.result()
+        except Exception as e:
+            listing_failed(url_of(parent), e)
+            yield parent, None
+            continue
+        yield parent, page
+        offsets = iter(range(len(page), total, len(page)) if page else ())
+        pages = deque(submit(parent, offset) for offset in itertools.islice(offsets, workers))
+        while pages:
+            future = pages.popleft()
+            pages.extend(submit(parent, offset) for offset in itertools.islice(offsets, 1))
             try:
-                dsjson = session.get(dsUrl).json()
-                # check if there are images in dataset = dataset exists
-                imgCount = dsjson['meta']['totalCount']
-                if imgCount == 0:
-                    imageIDsList.append(-2)
-                else:
-                    # get number of images in dataset
-                    i = 0
-                    while i < imgCount:
-                        # get ID, put in imageIDsList
-                        iID = dsjson['data'][i]['@id']
-                        imageIDsList.append(iID)
-                        i += 1
+                page, total = future.result()
             except Exception as e:
-                # dataset does not exist
-                imageIDsList.append(-2)
-    # else: idtype == 'Images' 
+                for future in pages:
+                    future.cancel()
+                listing_failed(url_of(parent), e)
+                page = None
+                pages.clear()
+            yield parent, page
+
+
+class ContainerWalk:
+    # bookkeeping of the listings of the given containers (see iter_container_images()): every image is
+    # yielded once, containers without images get the row of a missing container in the order of IdList
+    # and are put into the negative cache, containers known to be missing are not listed. Containers
+    # whose listing (or the listing of one of their children) failed get a placeholder row, as their
+    # images are incomplete.
+    def __init__(self, IdList, kind, cache=None, groups=None):
+        self.kind = kind
+        self.cache = cache
+        self.groups = groups
+        self.given = list(dict.fromkeys(IdList))
+        self.position = {ID: i for i, ID in enumerate(self.given)}
+        self.done = 0
+        self.counts = {}
+        self.failed = set()
+        self.known = set()
+        self.seen = set()
+
+    def containers(self):
+        # yields (given ID, container ID) of the given containers to list
+        for ID in self.given:
+            if self.cache is not None and self.cache.lookup_missing(self.kind, ID, '') is not None:
+                self.known.add(ID)
+                continue
+            yield ID, ID
+
+    def children(self, container, page):
+        # returns (given ID, child ID) of the children of a container on one page of its listing
+        ID = container[0]
+        if page is None:
+            self.failed.add(ID)
+            return []
+        return [(ID, child['@id']) for child in page]
+
+    def images(self, container, page, path):
+        # yields (image ID, image object) of the images on one page of a container's listing
+        ID = container[0]
+        if page is None:
+            self.failed.add(ID)
+            return
+        for obj in page:
+            for img in listed_images(path, obj):
+                self.counts[ID] = self.counts.get(ID, 0) + 1
+                imageId = group_image(self.groups, ID, img['@id'])
+                if imageId in self.seen:
+                    continue
+                self.seen.add(imageId)
+                yield from self.finish(self.position[ID])
+                yield imageId, img
+
+    def finish(self, end=None):
+        # yields the rows of the given containers before position end which have no images or failed
+        end = len(self.given) if end is None else end
+        while self.done < end:
+            ID = self.given[self.done]
+            self.done += 1
+            if ID in self.failed:
+                yield group_image(self.groups, ID, "%s %s" % (self.kind, ID)), FAILED_LISTING
+                continue
+            if self.counts.get(ID):
+                continue
+            if self.cache is not None and ID not in self.known:
+                self.cache.store_missing(self.kind, ID, '',
+                                         MISSING_DATASET if self.kind == 'dataset' else '%s does not exist' % self.kind)
+            yield group_image(self.groups, ID, CONTAINER_TYPES[self.kind][0]), None
+
+
+def iter_container_images(IdList, kind, urls, session, executor, workers=WORKERS, page_size=PAGE_SIZE, cache=None,
+                          groups=None, deadline=None):
+    # yields (image ID, image object of the listing) of the datasets, projects, screens or plates in
+    # IdList; the listings of every level (e.g. project -> datasets -> images) are read concurrently
+    # and the next level starts while the previous one is still being listed
+    steps = CONTAINER_TYPES[kind][1]
+    path = steps[-1][1]
+    walk = ContainerWalk(IdList, kind, cache, groups)
+    containers = walk.containers()
+    for step in steps[:-1]:
+        pages = iter_listing(containers, lambda c, step=step: listing_url(urls, step, c[1]), session, executor,
+                             workers, page_size, deadline)
+        containers = (child for container, page in pages for child in walk.children(container, page))
+    for container, page in iter_listing(containers, lambda c: listing_url(urls, steps[-1], c[1]), session,
+                                        executor, workers, page_size, deadline):
+        yield from walk.images(container, page, path)
+    yield from walk.finish()
+
+
+def group_image(groups, ID, imageId):
+    # notes that imageId was listed for the given ID (see SingleFlight)
+    if groups is not None:
+        groups.setdefault(ID, []).append(imageId)
+    return imageId
+
+
+def iter_images(IdList, idtype, urls, session, executor, page_size=PAGE_SIZE, cache=None, groups=None,
+                workers=WORKERS, deadline=None):
+    # yields (image ID, image object of the listing or None) to get metadata for;
+    # for containers the row ID of CONTAINER_TYPES (-2 for datasets) marks a container which is empty or
+    # does not exist; their listings are requested in the threads of executor.
+    # groups collects the image IDs per given ID, the listing requests end at the deadline
+    kind = container_type(idtype)
+    if kind is not None:
+        yield from iter_container_images(IdList, kind, urls, session, executor, workers, page_size, cache, groups,
+                                         deadline)
+    # else: idtype == 'Images'
     else:
-        imageIDsList = IdList
+        for ID in IdList:
+            yield group_image(groups, ID, ID), None
+
+
+def listing_is_complete(openBISUser, img):
+    # True if the image object of a dataset listing carries every field of the metadata
+    # sub-dictionary, so the image itself does not need to be requested
+    try:
+        if img['omero:details']['owner']['UserName'] != openBISUser:
+            return '@id' in img
+        pixels = img['Pixels']
+        return (all(k in img for k in ('@id', 'Name', 'Description'))
+                and all(k in pixels for k in ('SizeX', 'SizeY', 'SizeZ', 'SizeC', 'SizeT'))
+                and 'value' in pixels['Type'])
+    except (KeyError, TypeError):
+        return False
+
+
+class MetadataCache:
+    # SQLite cache of the image objects of the JSON API (only the fields of the metadata
+    # sub-dictionary), keyed by image ID. Entries expire after 'ttl' seconds, beyond 'size'
+    # entries the least recently used ones are evicted. Safe to use from several threads.
+    # A separate negative cache keeps failed lookups (see MISSING_IMAGE, MISSING_DATASET,
+    # NOT_OWNER) for 'negative_ttl' seconds and counts how many requests they saved.
+    # Every write is committed at once, so concurrent grabbers sharing the cache file do not wait
+    # for each other's runs; the access times of cache hits are written together by flush().
+    # A cache which cannot be read or written (e.g. locked for too long) counts as a cache miss.
+    def __init__(self, path, ttl=METADATA_CACHE_TTL, size=METADATA_CACHE_SIZE, negative_ttl=NEGATIVE_CACHE_TTL):
+        self.ttl = ttl
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        sqlite3 = timed_import('sqlite3')
+        self.Error = sqlite3.Error
+        self.accessed = {}
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS images (image_id INTEGER PRIMARY KEY, data TEXT, "
+                              "fetched REAL, accessed REAL)")
+            # negative cache: missing images and datasets, images of other owners
+            self.conn.execute("CREATE TABLE IF NOT EXISTS missing (kind TEXT, object_id TEXT, owner TEXT, "
+                              "reason TEXT, row TEXT, expires REAL, PRIMARY KEY (kind, object_id, owner))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS counters (reason TEXT PRIMARY KEY, "
+                              "stored INTEGER DEFAULT 0, hits INTEGER DEFAULT 0)")
+            self.conn.commit()
+
+    @staticmethod
+    def compact(img):
+        # returns the fields of an image object used for the metadata sub-dictionary,
+        # None if one of them is missing
+        try:
+            pixels = img['Pixels']
+            return {'@id': img['@id'],
+                    'Name': img['Name'],
+                    'Description': img['Description'],
+                    'omero:details': {'owner': {'UserName': img['omero:details']['owner']['UserName']}},
+                    'Pixels': {'SizeX': pixels['SizeX'], 'SizeY': pixels['SizeY'], 'SizeZ': pixels['SizeZ'],
+                               'SizeC': pixels['SizeC'], 'SizeT': pixels['SizeT'],
+                               'Type': {'value': pixels['Type']['value']}}}
+        except (KeyError, TypeError):
+            return None
+
+    def lookup(self, ID, count=True):
+        # returns the cached image object of ID, None if it is not cached or expired;
+        # without count the lookup is neither counted nor does it make the entry recently used
+        try:
+            ID = int(ID)
+        except (TypeError, ValueError):
+            return None
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.conn.execute("SELECT data FROM images WHERE image_id = ? AND fetched >= ?",
+                                        (ID, now - self.ttl)).fetchone()
+            except self.Error as e:
+                self.failed('read', e)
+                row = None
+            if not count:
+                return json.loads(row[0]) if row is not None else None
+            if row is None:
+                count_metric('cache', 'misses')
+                return None
+            self.accessed[ID] = now
+        count_metric('cache', 'hits')
+        return json.loads(row[0])
+
+    def store(self, img):
+        # caches an image object of the JSON API if it carries all fields
+        data = self.compact(img)
+        if data is None:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                                      (int(data['@id']), json.dumps(data), now, now))
+            except self.Error as e:
+                self.failed('write', e)
+
+    def lookup_missing(self, kind, ID, owner, count=True):
+        # returns the stored metadata sub-dictionary of a failed lookup ({} if there is none),
+        # None if the object is not in the negative cache; without count the hit is not counted
+        with self.lock:
+            try:
+                row = self.conn.execute("SELECT reason, row FROM missing WHERE kind = ? AND object_id = ? "
+                                        "AND owner IN ('', ?) AND expires > ?",
+                                        (kind, str(ID), owner or '', time.time())).fetchone()
+                if row is None:
+                    return None
+                if not count:
+                    return json.loads(row[1]) if row[1] else {}
+                with self.conn:
+                    self.count(row[0], 'hits')
+            except self.Error as e:
+                self.failed('read', e)
+                return None
+        count_metric('cache', 'negative_hits')
+        return json.loads(row[1]) if row[1] else {}
+
+    def store_missing(self, kind, ID, owner, reason, row=None):
+        # puts a failed lookup into the negative cache; owner is '' if the result is the same for all users
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?, ?, ?, ?)",
+                                      (kind, str(ID), owner or '', reason, json.dumps(row) if row else '',
+                                       time.time() + self.negative_ttl))
+                    self.count(reason, 'stored')
+            except self.Error as e:
+                self.failed('write', e)
+
+    def count(self, reason, counter):
+        # increments a counter of the negative cache, the lock has to be held
+        self.conn.execute("INSERT OR IGNORE INTO counters (reason) VALUES (?)", (reason,))
+        self.conn.execute("UPDATE counters SET %s = %s + 1 WHERE reason = ?" % (counter, counter), (reason,))
+
+    def failed(self, action, e):
+        # reports a failed access to the cache, which is then skipped like a cache miss
+        count_metric('cache', '%s_errors' % action)
+        print("Warning: cannot %s metadata cache: %s" % (action, str(e)), file=sys.stderr)
+
+    def stats(self):
+        # returns the counters of the negative cache: {reason: {'stored': n, 'hits': n}}
+        with self.lock:
+            rows = self.conn.execute("SELECT reason, stored, hits FROM counters ORDER BY reason").fetchall()
+        return {reason: {'stored': stored, 'hits': hits} for reason, stored, hits in rows}
+
+    def purge(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM images")
+            self.conn.execute("DELETE FROM missing")
+            self.conn.commit()
+
+    def flush(self):
+        # writes the access times of the cache hits and evicts expired and least recently used entries
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+            try:
+                with self.conn:
+                    self.conn.executemany("UPDATE images SET accessed = ? WHERE image_id = ?",
+                                          [(now, ID) for ID, now in accessed.items()])
+                    self.conn.execute("DELETE FROM images WHERE fetched < ?", (time.time() - self.ttl,))
+                    self.conn.execute("DELETE FROM missing WHERE expires <= ?", (time.time(),))
+                    self.conn.execute("DELETE FROM images WHERE image_id IN (SELECT image_id FROM images "
+                                      "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.size,))
+            except self.Error as e:
+                self.failed('write', e)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def open_metadata_cache(use_cache=True, purge=False):
+    # returns the MetadataCache of METADATA_CACHE, None if caching is disabled or the cache cannot be opened
+    if not METADATA_CACHE or not (use_cache or purge):
+        return None
+    sqlite3 = timed_import('sqlite3')
+    try:
+        cache = MetadataCache(METADATA_CACHE, METADATA_CACHE_TTL, METADATA_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+        if purge:
+            cache.purge()
+    except sqlite3.Error as e:
+        print("Warning: cannot open metadata cache %s: %s" % (METADATA_CACHE, str(e)), file=sys.stderr)
+        return None
+    if not use_cache:
+        cache.close()
+        return None
+    return cache
+
+
+def listed_owner(img):
+    # returns the owner name of an image object of a dataset listing, None if it is not listed
+    try:
+        return img['omero:details']['owner']['UserName']
+    except (KeyError, TypeError):
+        return None
+
+
+def reusable_row(row):
+    # True if a row of the previous output can be reused: rows of fetched images, missing images and
+    # images of other owners. Placeholders and rows of failed requests are requested again.
+    if not isinstance(row, dict):
+        return False
+    return row.get('Username', '-') != '-' or row.get('Description') in (MISSING_IMAGE_DESCRIPTION,
+                                                                        NOT_OWNER_DESCRIPTION)
+
+
+def known_metadata(openBISUser, ID, img, bulk=BULK, cache=None, refresh=False, previous=None, count=True):
+    # returns the metadata sub-dictionary of an image if it can be built without requesting the image:
+    # images of other owners and, in bulk mode, all images from the dataset listing, otherwise from
+    # the previous output of an incremental run or from the cache (unless it is refreshed).
+    # Containers with a failed listing get a placeholder, so their rows are requested again later.
+    # Without count, hits of the previous output and the cache are not counted (see cached_core_metadata()).
+    if img is FAILED_LISTING:
+        return unavailable_metadata(ID, -1)
+    owner = listed_owner(img) if img is not None else None
+    if owner is not None and owner != openBISUser and '@id' in img:
+        return parse_image_metadata(openBISUser, ID, {'data': img})
+    if bulk and img is not None and listing_is_complete(openBISUser, img):
+        if cache is not None:
+            cache.store(img)
+        count_metric('cache', 'listing_hits')
+        return parse_image_metadata(openBISUser, ID, {'data': img})
+    if previous is not None and not refresh and reusable_row(previous.get("%s" % ID)):
+        if count:
+            count_metric('cache', 'previous_hits')
+        return previous["%s" % ID]
+    if cache is not None and not refresh and ID not in MISSING_CONTAINERS:
+        row = cache.lookup_missing('image', ID, openBISUser, count)
+        if row:
+            return row
+        data = cache.lookup(ID, count)
+        if data is not None:
+            return parse_image_metadata(openBISUser, ID, {'data': data})
+    return None
+
+
+def cached_core_metadata(openBISUser, IdList, idtype, metadata, cache, previous=None):
+    # returns the metadata of image IDs if all of them are cached or in the previous output,
+    # so no OMERO session is needed; None if one image is missing or the IDs are container IDs.
+    # The hits are only counted if the rows are used, otherwise the images are looked up again later.
+    if (cache is None and previous is None) or container_type(idtype) is not None:
+        return None
+    for ID in IdList:
+        if known_metadata(openBISUser, ID, None, False, cache, False, previous, False) is None:
+            return None
+    for ID in IdList:
+        metadata["%s" % ID] = known_metadata(openBISUser, ID, None, False, cache, False, previous)
+    return metadata
+
+
+class SingleFlight:
+    # Coalesces the requests of concurrent grabbers (processes or daemon threads) for the same
+    # (idtype, ID, owner): the first one locks the lock file of the key in SINGLEFLIGHT_DIR and
+    # requests OMERO, the others wait for the lock and take the rows it wrote into the lock file.
+    # The lock files are readable for their owner only and removed when the first grabber releases
+    # them; the waiting grabbers keep them open until they read the rows.
+    def __init__(self, idtype, owner):
+        self.idtype = idtype.lower()
+        self.owner = owner
+        self.held = {}
+        # lock files of keys which other grabbers hold
+        self.opened = {}
+
+    def path(self, ID):
+        key = json.dumps([self.idtype, "%s" % ID, self.owner])
+        return os.path.join(SINGLEFLIGHT_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock')
+
+    def lock(self, ID, wait):
+        # tries to lock the key of ID (for at most 'wait' seconds), True if this grabber holds it now;
+        # otherwise the lock file stays open to read the rows of the holder later
+        f = self.opened.pop(ID, None)
+        if f is None:
+            f = os.fdopen(os.open(self.path(ID), os.O_RDWR | os.O_CREAT, 0o600), 'r+')
+        deadline = time.time() + wait
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.held[ID] = f
+                return True
+            except (IOError, OSError):
+                if time.time() >= deadline:
+                    self.opened[ID] = f
+                    return False
+                time.sleep(0.05)
+
+    def acquire(self, IdList):
+        # locks all keys which are free, returns the IDs nobody else is requesting
+        return [ID for ID in IdList if self.lock(ID, 0)]
+
+    def wait(self, IdList, since, wait):
+        # waits (until 'wait' seconds after 'since') for the grabbers requesting IdList and returns
+        # {ID: rows} of the ones which finished after 'since'; the keys of IDs without result stay
+        # locked, so this grabber can request them
+        results = {}
+        for ID in IdList:
+            if not self.lock(ID, max(0, since + wait - time.time())):
+                continue
+            f = self.held[ID]
+            try:
+                f.seek(0)
+                result = json.loads(f.read() or '{}')
+            except ValueError:
+                result = {}
+            if result.get('done', 0) >= since:
+                results[ID] = result['rows']
+                self.release([ID])
+        return results
+
+    def publish(self, results):
+        # writes the rows of the locked keys into their lock files for the waiting grabbers
+        for ID, rows in results.items():
+            f = self.held.get(ID)
+            if f is None:
+                continue
+            try:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({'done': time.time(), 'rows': rows}))
+                f.flush()
+            except (IOError, OSError) as e:
+                print("Warning: cannot write %s: %s" % (f.name, str(e)), file=sys.stderr)
+
+    def release(self, IdList=None):
+        # unlocks and removes the lock files of the given keys (all keys if IdList is None) which this
+        # grabber holds, grabbers which opened them before still read the rows from them
+        for ID in list(self.held) if IdList is None else IdList:
+            f = self.held.pop(ID, None)
+            if f is not None:
+                self.remove(ID, f)
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+        if IdList is None:
+            for f in self.opened.values():
+                f.close()
+            self.opened.clear()
+
+    def remove(self, ID, f):
+        # removes the lock file of ID unless another grabber created a new one after it was removed
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(self.path(ID))):
+                os.unlink(self.path(ID))
+        except OSError:
+            pass
+
+
+def group_rows(metadata, groups):
+    # returns {given ID: [[image ID, metadata sub-dictionary], ...]} of the fetched metadata
+    return {ID: [["%s" % imageId, metadata["%s" % imageId]] for imageId in imageIds
+                 if "%s" % imageId in metadata]
+            for ID, imageIds in groups.items()}
+
+
+def fetch_rows(flight, IdList, fetch):
+    # requests IdList with fetch(IdList, groups) and hands the rows to the grabbers waiting for them
+    groups = {}
+    metadata = fetch(IdList, groups)
+    rows = group_rows(metadata or {}, groups)
+    flight.publish(rows)
+    flight.release(IdList)
+    return rows
+
+
+def coalesced_core_metadata(openBISUser, IdList, idtype, fetch, wait=None):
+    # returns the metadata of IdList like fetch(IdList, groups), but IDs which another grabber is
+    # requesting right now are taken from its result instead of requesting them again
+    IdList = list(dict.fromkeys(IdList))
+    flight = SingleFlight(idtype, openBISUser)
+    since = time.time()
+    results = {}
+    try:
+        lead = flight.acquire(IdList)
+        others = [ID for ID in IdList if ID not in flight.held]
+        if lead:
+            results.update(fetch_rows(flight, lead, fetch))
+        if others:
+            with timed_phase('singleflight'):
+                shared = flight.wait(others, since, SINGLEFLIGHT_WAIT if wait is None else wait)
+            count_metric('cache', 'singleflight_hits', len(shared))
+            results.update(shared)
+            # IDs whose grabber failed or took longer than SINGLEFLIGHT_WAIT are requested by this grabber
+            rest = [ID for ID in others if ID not in shared]
+            if rest:
+                results.update(fetch_rows(flight, rest, fetch))
+    finally:
+        flight.release()
+
+    metadata = {}
+    for ID in IdList:
+        for imageId, row in results.get(ID, []):
+            metadata[imageId] = row
+    if not metadata:
+        return None
+    return metadata
+
+
+class Deadline:
+    # latency budget of a run (see --deadline-ms): images which are not fetched in time get a
+    # placeholder row and are collected in 'pending'
+    def __init__(self, ms, start=None):
+        self.end = (time.perf_counter() if start is None else start) + ms / 1000.0
+        self.pending = []
+
+    def remaining(self):
+        return max(0.0, self.end - time.perf_counter())
+
+    def expired(self, ID=None):
+        # True if the budget is used up (missing datasets, ID -2, and other containers are never late)
+        return ID not in MISSING_CONTAINERS and time.perf_counter() >= self.end
+
+    def placeholder(self, ID):
+        self.pending.append(ID)
+        count_metric('pending')
+        return default_metadata(ID, ID, PENDING_DESCRIPTION)
+
+
+def iter_core_metadata(openBISUser, images, images_url, session, executor, workers=WORKERS, bulk=BULK, cache=None,
+                       refresh=False, previous=None, deadline=None):
+    # yields (ID, metadata sub-dictionary) in the order of images; the images are requested in the
+    # threads of executor and fetching starts while images is still being listed.
+    # In bulk mode images of a dataset listing are only requested if fields are missing,
+    # cached images are not requested at all. After the deadline no more images are requested.
+    def fetch(ID):
+        return get_image_metadata(openBISUser, ID, images_url, session, cache)
+
+    def from_listing(ID, img):
+        return known_metadata(openBISUser, ID, img, bulk, cache, refresh, previous)
+
+    futures = timed_import('concurrent.futures')
+
+    def result(ID, future):
+        # waits for a request at most until the deadline
+        if deadline is None:
+            return future.result()
+        try:
+            return future.result(timeout=deadline.remaining())
+        except futures.TimeoutError:
+            future.cancel()
+            return deadline.placeholder(ID)
 
-    if not len(imageIDsList):
+    # only a few requests wait in the queue, so memory does not grow with the number of images
+    pending = deque()
+    for ID, img in images:
+        row = from_listing(ID, img)
+        if row is None and deadline is not None and deadline.expired(ID):
+            row = deadline.placeholder(ID)
+        if row is not None:
+            future = futures.Future()
+            future.set_result(row)
+        else:
+            future = executor.submit(fetch, ID)
+        pending.append((ID, future))
+        if len(pending) >= 4 * workers:
+            ID, future = pending.popleft()
+            yield ID, result(ID, future)
+    while pending:
+        ID, future = pending.popleft()
+        yield ID, result(ID, future)
+
+
+def get_core_metadata(openBISUser, IdList, idtype, metadata, urls, session, workers=WORKERS,
+                      page_size=PAGE_SIZE, bulk=BULK, cache=None, refresh=False, previous=None, groups=None,
+                      deadline=None):
+    # for every image get json core metadata via JSON API; images of other owners in the listings
+    # of containers get their "access denied" row from the listing, they are not requested at all.
+    # Listing pages and images are requested in the same threads, so at most 'workers' requests run at a time.
+    futures = timed_import('concurrent.futures')
+    workers = max(1, workers)
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        images = iter_images(IdList, idtype, urls, session, executor, page_size, cache, groups, workers, deadline)
+        for ID, row in iter_core_metadata(openBISUser, images, urls['url:images'], session, executor, workers, bulk,
+                                          cache, refresh, previous, deadline):
+            metadata["%s" % ID] = row
+    finally:
+        # after the deadline the requests still running are not waited for
+        executor.shutdown(wait=deadline is None or not deadline.pending)
+
+    if not len(metadata):
         print("Error: there are no images in images_List")
         return
 
-    # for every image in list get json core metadata via JSON API
-    for ID in imageIDsList:
-        # create sub-dictionary and build image_url
-        metadata["%s" % ID] = {}
-        imgUrl = images_url + str(ID) + '/'
-        # handle not existing dataset
-        if ID == -2:
-           fill_dict_default(metadata,ID)
-           fill_dict(metadata, ID, 'ID', -1)
-           fill_dict(metadata, ID, 'Description', "One given ID does not correspond to an existing OMERO dataset")
-        # dataset exists or instead image IDs were given
-        else:
-            try:
-                imgjson = session.get(imgUrl).json()
-                # if image exists in OMERO database
+    return metadata
+
+
+class OmeroUnavailable(Exception):
+    # raised instead of sending a request to OMERO.web while the circuit breaker is open
+    pass
+
+
+class OmeroGuard:
+    # Token bucket rate limiter and circuit breaker for the requests to OMERO.web. With GUARD_STATE
+    # the state is kept in a locked file, so all grabbers on the ELN server share one budget. A state
+    # file which cannot be opened or belongs to another user is not used (the state is kept per process).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = self.initial_state()
+        self.shared = True
+
+    @staticmethod
+    def initial_state():
+        return {'tokens': RATE_BURST, 'updated': time.time(), 'failures': 0, 'open_until': 0}
+
+    @contextmanager
+    def shared_state(self):
+        # yields the state dictionary, changes are written back to GUARD_STATE
+        with self.lock:
+            f = self.open_state() if GUARD_STATE and fcntl is not None and self.shared else None
+            if f is None:
+                yield self.state
+                return
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
                 try:
-                    imgjson['data']['@id']
-                    # if the ELN user is the image owner & allowed to get the image metadata
-                    if imgjson['data']['omero:details']['owner']['UserName'] == openBISUser:
-                        # parse information from json to our metadata dict
-                            fill_dict(metadata, ID, 'Name', imgjson['data']['Name'])                      
-                            fill_dict(metadata, ID, 'ID', imgjson['data']['@id'])                       
-                            fill_dict(metadata, ID, 'Username', imgjson['data']['omero:details']['owner']['UserName'])                       
-                            fill_dict(metadata, ID, 'Description', imgjson['data']['Description'])                        
-                            fill_dict(metadata, ID, 'SizeX', imgjson['data']['Pixels']['SizeX'])                        
-                            fill_dict(metadata, ID, 'SizeY', imgjson['data']['Pixels']['SizeY'])                        
-                            fill_dict(metadata, ID, 'Pixel Type', imgjson['data']['Pixels']['Type']['value'])                       
-                            fill_dict(metadata, ID, 'SizeZ', imgjson['data']['Pixels']['SizeZ'])                        
-                            fill_dict(metadata, ID, 'SizeC', imgjson['data']['Pixels']['SizeC'])                        
-                            fill_dict(metadata, ID, 'SizeT', imgjson['data']['Pixels']['SizeT'])
-                    else:
-                        # if the ELN user is not the image owner & not allowed to get the image metadata,
-                        # give this info as descr and the ID of the image
-                        fill_dict_default(metadata,ID)                      
-                        fill_dict(metadata, ID, 'ID', imgjson['data']['@id'])                        
-                        fill_dict(metadata, ID, 'Description', "This ELN User is not the image owner: metadata access denied")
-                        
-                except Exception as e:
-                    # cannot get image json for image ID
-                    #print("Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
-                    fill_dict_default(metadata,ID) 
-                    fill_dict(metadata, ID, 'ID', ID)
-                    fill_dict(metadata, ID, 'Description', "Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
-            except Exception as e:
-                # this image does not exist in the OMERO database
-                #print("This image does not exists in the OMERO database")
-                fill_dict_default(metadata,ID) 
-                fill_dict(metadata, ID, 'ID', ID)
-                fill_dict(metadata, ID, 'Description', "This image does not exist in the OMERO database")
+                    f.seek(0)
+                    content = f.read()
+                    try:
+                        state = json.loads(content)
+                    except ValueError:
+                        state = self.initial_state()
+                    yield state
+                    if json.dumps(state) != content:
+                        f.seek(0)
+                        f.truncate()
+                        f.write(json.dumps(state))
+                        f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
 
-    return metadata
+    def open_state(self):
+        # opens GUARD_STATE (created readable for its owner only), None if it cannot be used
+        try:
+            f = os.fdopen(os.open(GUARD_STATE, os.O_RDWR | os.O_CREAT, 0o600), 'r+')
+        except OSError as e:
+            reason = str(e)
+        else:
+            if os.fstat(f.fileno()).st_uid == os.getuid():
+                return f
+            f.close()
+            reason = "the file belongs to another user"
+        self.shared = False
+        print("Warning: cannot use GUARD_STATE %s (%s), the rate limit and circuit breaker only apply to "
+              "this grabber" % (GUARD_STATE, reason), file=sys.stderr)
+        return None
+
+    def is_open(self):
+        # True while OMERO.web is considered unhealthy
+        with self.shared_state() as state:
+            return state['open_until'] > time.time()
+
+    def reserve(self):
+        # takes a token for one request, returns the seconds to wait before sending it
+        now = time.time()
+        with self.shared_state() as state:
+            if state['open_until'] > now:
+                raise OmeroUnavailable("OMERO.web failed %d times in a row, retrying after %s"
+                                       % (state['failures'], time.strftime('%H:%M:%S',
+                                                                          time.localtime(state['open_until']))))
+            if RATE_LIMIT <= 0:
+                return 0.0
+            state['tokens'] = min(RATE_BURST, state['tokens'] + (now - state['updated']) * RATE_LIMIT) - 1
+            state['updated'] = now
+            return max(0.0, -state['tokens'] / RATE_LIMIT)
+
+    def record(self, ok):
+        # counts a failed request or resets the failures after a successful one
+        with self.shared_state() as state:
+            if ok:
+                state['failures'] = 0
+                return
+            state['failures'] += 1
+            if state['failures'] >= BREAKER_FAILURES:
+                state['open_until'] = time.time() + BREAKER_COOLDOWN
+
+
+def omero_guard():
+    # returns the OmeroGuard of this process
+    global GUARD
+    if GUARD is None:
+        GUARD = OmeroGuard()
+    return GUARD
+
+
+def retry_delay(attempt):
+    # jittered exponential backoff before repeating a request
+    return random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+
+
+def response_ok(status):
+    # False if the status means OMERO.web is overloaded or broken
+    return status < 500 and status != 429
 
 
-def get_omero_session():
+def request_timeout(deadline=None):
+    # timeout of one request: REQUEST_TIMEOUT, with a deadline at most the time left of it
+    # (a timeout of 0 is not accepted, so an expired deadline gives a request 10 ms)
+    if deadline is None:
+        return REQUEST_TIMEOUT
+    return min(REQUEST_TIMEOUT, max(0.01, deadline.remaining()))
+
+
+def last_attempt(attempt, attempts, deadline=None):
+    # True if a failed request is not repeated: no attempts are left or the deadline has passed
+    return attempt + 1 >= attempts or (deadline is not None and deadline.expired())
+
+
+def omero_request(session, method, url, retries=None, deadline=None, **kwargs):
+    # sends a request with the requests session through the rate limiter and circuit breaker,
+    # failed requests are repeated up to 'retries' times (default: RETRIES for GET, else 0).
+    # With a deadline (see Deadline) no attempt waits longer than the time left of it.
+    requests = timed_import('requests')
+    guard = omero_guard()
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    attempts = 1 + (retries if retries is not None else RETRIES if method == 'GET' else 0)
+    for attempt in range(attempts):
+        time.sleep(guard.reserve())
+        if deadline is not None:
+            kwargs['timeout'] = request_timeout(deadline)
+        try:
+            r = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            # a request cut short by the deadline says nothing about OMERO.web
+            if deadline is None or not deadline.expired():
+                guard.record(False)
+            if last_attempt(attempt, attempts, deadline):
+                raise
+        else:
+            guard.record(response_ok(r.status_code))
+            if response_ok(r.status_code) or last_attempt(attempt, attempts, deadline):
+                return r
+        count_metric('http_retries')
+        time.sleep(retry_delay(attempt))
+
+
+def login_omero_session(session, deadline=None):
     # request a session for login to Omero Server via  SUDO_USERNAME User created for this purpose
-    # (Admin with read only access)
+    # (Admin with read only access), returns the urls listed by the JSON API; the requests end at the deadline
     # how to use JSON-API of OMERO see: https://docs.openmicroscopy.org/omero/5.6.0/developers/json-api.html
-    session = requests.Session()
     # Start by getting supported versions from the base url...
     api_url = '%s/api/' % OMERO_WEB_HOST
-    r = session.get(api_url)
+    r = omero_request(session, 'GET', api_url, deadline=deadline)
     # we get a list of versions
     versions = r.json()['data']
     # use most recent version...
     version = versions[-1]
     # get the 'base' url
     base_url = version['url:base']
-    r = session.get(base_url)
+    r = omero_request(session, 'GET', base_url, deadline=deadline)
     # which lists a bunch of urls as starting points
     urls = r.json()
     servers_url = urls['url:servers']
     login_url = urls['url:login']
-    images_url = urls['url:images']
-    datasets_url = urls['url:datasets']
     # To login, we need to get CSRF token
     token_url = urls['url:token']
-    token = session.get(token_url).json()['data']
+    token = omero_request(session, 'GET', token_url, deadline=deadline).json()['data']
     # We add this to our session header
     # Needed for all POST, PUT, DELETE requests
     session.headers.update({'X-CSRFToken': token,
                             'Referer': login_url})
     # List the servers available to connect
-    servers = session.get(servers_url).json()['data']
+    servers = omero_request(session, 'GET', servers_url, deadline=deadline).json()['data']
     # find one called SERVER_NAME
     servers = [s for s in servers if s['server'] == SERVER_NAME]
     if len(servers) < 1:
@@ -291,7 +1816,8 @@ def get_omero_session():
                'password': PASSWORD,
                # 'csrfmiddlewaretoken': token,  # Using CSRFToken in header instead
                'server': server['id']}
-    r = session.post(login_url, data=payload)
+    # a failed login can safely be repeated
+    r = omero_request(session, 'POST', login_url, retries=RETRIES, deadline=deadline, data=payload)
     login_rsp = r.json()
     assert r.status_code == 200
     assert login_rsp['success']
@@ -299,15 +1825,585 @@ def get_omero_session():
     # With successful login, request.session will contain
     # OMERO session details and reconnect to OMERO on each subsequent call...
 
-    return images_url, datasets_url, session
+    return urls
+
+
+@contextmanager
+def session_cache_lock():
+    # holds an exclusive lock on SESSION_CACHE, so concurrent grabbers wait for one login
+    # instead of logging in at the same time
+    if fcntl is None:
+        yield
+        return
+    with open(SESSION_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_session_cache():
+    # returns the cached session of OMERO_WEB_HOST, None if there is none or it is older than SESSION_TTL
+    try:
+        with open(SESSION_CACHE, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('host') != OMERO_WEB_HOST or time.time() - entry.get('created', 0) > SESSION_TTL:
+        return None
+    return entry
+
+
+def save_session_cache(cookies, headers, urls):
+    # writes session cookies, CSRF header and urls to SESSION_CACHE (readable for the owner only)
+    entry = {'host': OMERO_WEB_HOST,
+             'created': time.time(),
+             'cookies': cookies,
+             'headers': headers,
+             'urls': urls}
+    tmpfile = SESSION_CACHE + '.tmp'
+    with os.fdopen(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmpfile, SESSION_CACHE)
+
+
+def new_session(pool_size=WORKERS):
+    # returns a requests.Session which keeps enough connections open for concurrent image requests
+    requests = timed_import('requests')
+    timed_import('requests.adapters')
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(count_response)
+    return session
+
+
+def session_is_valid(session, images_url, deadline=None):
+    # cheap check whether OMERO still knows the session: list a single image
+    try:
+        r = omero_request(session, 'GET', images_url, deadline=deadline, params={'limit': 1})
+        return r.status_code == 200 and 'data' in r.json()
+    except Exception as e:
+        return False
+
+
+def get_omero_session(pool_size=WORKERS, deadline=None):
+    # returns the urls of the JSON API and a logged in session; with SESSION_CACHE the session of
+    # a previous run is reused as long as it is younger than SESSION_TTL and still accepted by OMERO
+    if not SESSION_CACHE:
+        session = new_session(pool_size)
+        urls = login_omero_session(session, deadline)
+        return urls, session
+
+    with session_cache_lock():
+        entry = load_session_cache()
+        if entry is not None:
+            session = new_session(pool_size)
+            session.cookies.update(entry['cookies'])
+            session.headers.update(entry['headers'])
+            urls = entry['urls']
+            if session_is_valid(session, urls['url:images'], deadline):
+                return urls, session
+        session = new_session(pool_size)
+        urls = login_omero_session(session, deadline)
+        try:
+            save_session_cache(session.cookies.get_dict(),
+                               {k: session.headers[k] for k in ('X-CSRFToken', 'Referer')}, urls)
+        except OSError as e:
+            print("Warning: cannot write session cache %s: %s" % (SESSION_CACHE, str(e)), file=sys.stderr)
+
+    return urls, session
+
+
+async def omero_request_async(session, method, url, retries=None, deadline=None, **kwargs):
+    # asyncio version of omero_request(), returns status and body of the response
+    guard = omero_guard()
+    attempts = 1 + (retries if retries is not None else RETRIES if method == 'GET' else 0)
+    for attempt in range(attempts):
+        await asyncio.sleep(guard.reserve())
+        if deadline is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=request_timeout(deadline))
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                status, body = r.status, await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if deadline is None or not deadline.expired():
+                guard.record(False)
+            if last_attempt(attempt, attempts, deadline):
+                raise
+        else:
+            guard.record(response_ok(status))
+            if response_ok(status) or last_attempt(attempt, attempts, deadline):
+                return status, body
+        count_metric('http_retries')
+        await asyncio.sleep(retry_delay(attempt))
+
+
+async def get_json_async(session, url, **kwargs):
+    # GET request of the asyncio engine, returns the decoded JSON response
+    status, body = await omero_request_async(session, 'GET', url, **kwargs)
+    return json.loads(body)
+
+
+async def login_omero_session_async(session, deadline=None):
+    # asyncio version of login_omero_session()
+    api_url = '%s/api/' % OMERO_WEB_HOST
+    versions = (await get_json_async(session, api_url, deadline=deadline))['data']
+    base_url = versions[-1]['url:base']
+    urls = await get_json_async(session, base_url, deadline=deadline)
+    servers_url = urls['url:servers']
+    login_url = urls['url:login']
+    # CSRF token and server list do not depend on each other
+    token, servers = await asyncio.gather(get_json_async(session, urls['url:token'], deadline=deadline),
+                                          get_json_async(session, servers_url, deadline=deadline))
+    session.headers.update({'X-CSRFToken': token['data'],
+                            'Referer': login_url})
+    servers = [s for s in servers['data'] if s['server'] == SERVER_NAME]
+    if len(servers) < 1:
+        raise Exception("Found no server called '%s'" % SERVER_NAME)
+    payload = {'username': SUDO_USERNAME,
+               'password': PASSWORD,
+               'server': servers[0]['id']}
+    status, body = await omero_request_async(session, 'POST', login_url, retries=RETRIES, deadline=deadline,
+                                             data=payload)
+    login_rsp = json.loads(body)
+    assert status == 200
+    assert login_rsp['success']
+
+    return urls
+
+
+async def count_response_async(session, context, params):
+    # on_request_end trace of the aiohttp sessions
+    count_metric('http_requests')
+    count_metric('http_status', str(params.response.status))
+
+
+async def count_chunk_async(session, context, params):
+    # on_response_chunk_received trace of the aiohttp sessions
+    count_metric('http_bytes', n=len(params.chunk))
+
+
+def new_session_async(pool_size=WORKERS):
+    # returns an aiohttp session with at most pool_size keep-alive connections to OMERO_WEB_HOST
+    connector = aiohttp.TCPConnector(limit_per_host=max(1, pool_size))
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(count_response_async)
+    trace.on_response_chunk_received.append(count_chunk_async)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace],
+                                 cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+
+async def get_omero_session_async(pool_size=WORKERS, deadline=None):
+    # asyncio version of get_omero_session()
+    if not SESSION_CACHE:
+        session = new_session_async(pool_size)
+        try:
+            urls = await login_omero_session_async(session, deadline)
+        except BaseException:
+            await session.close()
+            raise
+        return urls, session
+
+    with session_cache_lock():
+        entry = load_session_cache()
+        if entry is not None:
+            session = new_session_async(pool_size)
+            session.cookie_jar.update_cookies(entry['cookies'], response_url=URL(OMERO_WEB_HOST))
+            session.headers.update(entry['headers'])
+            urls = entry['urls']
+            try:
+                status, body = await omero_request_async(session, 'GET', urls['url:images'], deadline=deadline,
+                                                         params={'limit': 1})
+                if status == 200 and 'data' in json.loads(body):
+                    return urls, session
+            except Exception as e:
+                pass
+            await session.close()
+        session = new_session_async(pool_size)
+        try:
+            urls = await login_omero_session_async(session, deadline)
+        except BaseException:
+            await session.close()
+            raise
+        try:
+            save_session_cache({c.key: c.value for c in session.cookie_jar},
+                               {k: session.headers[k] for k in ('X-CSRFToken', 'Referer')}, urls)
+        except OSError as e:
+            print("Warning: cannot write session cache %s: %s" % (SESSION_CACHE, str(e)), file=sys.stderr)
+
+    return urls, session
+
+
+async def get_image_metadata_async(openBISUser, ID, images_url, session, cache=None):
+    # asyncio version of get_image_metadata()
+    if ID in MISSING_CONTAINERS:
+        return missing_container_metadata(ID)
+    status = None
+    try:
+        status, body = await omero_request_async(session, 'GET', images_url + str(ID) + '/')
+        if not response_ok(status):
+            return unavailable_metadata(ID)
+        imgjson = json.loads(body)
+    except OmeroUnavailable as e:
+        return unavailable_metadata(ID)
+    except Exception as e:
+        if status != 404:
+            count_metric('errors', REQUEST_FAILED)
+            return default_metadata(ID, ID, "Error: cannot get imgjson for ID %s: %s " % (str(ID), str(e)))
+        row = default_metadata(ID, ID, MISSING_IMAGE_DESCRIPTION)
+        count_metric('errors', MISSING_IMAGE)
+        if cache is not None:
+            cache.store_missing('image', ID, '', MISSING_IMAGE, row)
+        return row
+
+    return image_metadata_from_response(openBISUser, ID, imgjson, status, cache)
+
+
+async def get_listing_page_async(session, url, page_size=PAGE_SIZE, offset=0, deadline=None):
+    # asyncio version of get_listing_page()
+    with timed_phase('datasets'):
+        status, body = await omero_request_async(session, 'GET', url, deadline=deadline,
+                                                 params=listing_params(page_size, offset))
+        if status >= 400:
+            raise Exception("status %d" % status)
+        listing = json.loads(body)
+    return listing['data'], listing['meta']['totalCount']
+
+
+async def iter_listing_async(parents, url_of, session, workers=WORKERS, page_size=PAGE_SIZE, deadline=None):
+    # asyncio version of iter_listing(), parents is an asynchronous iterator
+    def submit(parent, offset=0):
+        return asyncio.ensure_future(get_listing_page_async(session, url_of(parent), page_size, offset, deadline))
+
+    async def fill():
+        async for parent in parents:
+            ahead.append((parent, submit(parent)))
+            if len(ahead) >= workers:
+                return
+
+    ahead = deque()
+    pages = deque()
+    try:
+        await fill()
+        while ahead:
+            parent, task = ahead.popleft()
+            await fill()
+            try:
+                page, total = await task
+            except Exception as e:
+                listing_failed(url_of(parent), e)
+                yield parent, None
+                continue
+            yield parent, page
+            offsets = iter(range(len(page), total, len(page)) if page else ())
+            pages.extend(submit(parent, offset) for offset in itertools.islice(offsets, workers))
+            while pages:
+                task = pages.popleft()
+                pages.extend(submit(parent, offset) for offset in itertools.islice(offsets, 1))
+                try:
+                    page, total = await task
+                except Exception as e:
+                    listing_failed(url_of(parent), e)
+                    yield parent, None
+                    break
+                yield parent, page
+            for task in pages:
+                task.cancel()
+            pages.clear()
+    finally:
+        for task in itertools.chain((task for parent, task in ahead), pages):
+            task.cancel()
+
+
+async def iter_async(items):
+    # asynchronous iterator over items
+    for item in items:
+        yield item
+
+
+async def iter_children_async(walk, pages):
+    # asyncio version of the children of a listing level in iter_container_images()
+    async for container, page in pages:
+        for child in walk.children(container, page):
+            yield child
+
+
+async def iter_container_images_async(IdList, kind, urls, session, workers=WORKERS, page_size=PAGE_SIZE,
+                                      cache=None, groups=None, deadline=None):
+    # asyncio version of iter_container_images()
+    steps = CONTAINER_TYPES[kind][1]
+    path = steps[-1][1]
+    walk = ContainerWalk(IdList, kind, cache, groups)
+    containers = iter_async(walk.containers())
+    for step in steps[:-1]:
+        pages = iter_listing_async(containers, lambda c, step=step: listing_url(urls, step, c[1]), session,
+                                   workers, page_size, deadline)
+        containers = iter_children_async(walk, pages)
+    async for container, page in iter_listing_async(containers, lambda c: listing_url(urls, steps[-1], c[1]),
+                                                    session, workers, page_size, deadline):
+        for item in walk.images(container, page, path):
+            yield item
+    for item in walk.finish():
+        yield item
+
+
+async def iter_images_async(IdList, idtype, urls, session, page_size=PAGE_SIZE, cache=None, groups=None,
+                            workers=WORKERS, deadline=None):
+    # asyncio version of iter_images()
+    kind = container_type(idtype)
+    if kind is not None:
+        async for item in iter_container_images_async(IdList, kind, urls, session, workers, page_size, cache,
+                                                      groups, deadline):
+            yield item
+    else:
+        for ID in IdList:
+            yield group_image(groups, ID, ID), None
+
+
+async def get_core_metadata_async(openBISUser, IdList, idtype, metadata, urls, session,
+                                  workers=WORKERS, page_size=PAGE_SIZE, bulk=BULK, cache=None, refresh=False,
+                                  previous=None, groups=None, deadline=None):
+    # asyncio version of get_core_metadata(): images are requested while the dataset listings
+    # are read, the number of open connections is limited by the session
+    async def result(ID, task):
+        # waits for a request at most until the deadline
+        if deadline is None:
+            return await task
+        try:
+            return await asyncio.wait_for(task, deadline.remaining())
+        except asyncio.TimeoutError:
+            return deadline.placeholder(ID)
+
+    images_url = urls['url:images']
+    pending = deque()
+    async for ID, img in iter_images_async(IdList, idtype, urls, session, page_size, cache, groups, workers,
+                                           deadline):
+        row = known_metadata(openBISUser, ID, img, bulk, cache, refresh, previous)
+        if row is None and deadline is not None and deadline.expired(ID):
+            row = deadline.placeholder(ID)
+        if row is not None:
+            task = asyncio.get_running_loop().create_future()
+            task.set_result(row)
+        else:
+            task = asyncio.ensure_future(get_image_metadata_async(openBISUser, ID, images_url, session, cache))
+        pending.append((ID, task))
+        if len(pending) >= 4 * workers:
+            ID, task = pending.popleft()
+            metadata["%s" % ID] = await result(ID, task)
+    while pending:
+        ID, task = pending.popleft()
+        metadata["%s" % ID] = await result(ID, task)
+
+    if not len(metadata):
+        print("Error: there are no images in images_List")
+        return
+
+    return metadata
+
+
+async def run_async(omeroUsername, idList, idtype, metadata, workers, page_size, bulk, cache=None,
+                    refresh=False, previous=None, groups=None, deadline=None):
+    # login and metadata requests of the asyncio engine, same error handling as run_script()
+    try:
+        with timed_phase('login'):
+            urls, session = await get_omero_session_async(workers, deadline)
+    except OmeroUnavailable as e:
+        return unavailable_core_metadata(omeroUsername, idList, idtype, cache, previous, groups)
+    except Exception as e:
+        if deadline is not None and deadline.expired():
+            # the login did not finish in time, the images are requested again by the next run
+            return unavailable_core_metadata(omeroUsername, idList, idtype, cache, previous, groups)
+        count_metric('errors', LOGIN_FAILED)
+        print("Error in get_omero_session: ", str(e))
+        return {}
+    try:
+        with timed_phase('metadata'):
+            return await get_core_metadata_async(omeroUsername, idList, idtype, metadata, urls, session,
+                                                 workers, page_size, bulk, cache, refresh, previous, groups,
+                                                 deadline)
+    finally:
+        await session.close()
+
+
+def unavailable_core_metadata(openBISUser, IdList, idtype, cache=None, previous=None, groups=None):
+    # returns the metadata of IdList without contacting OMERO: cached rows and rows of the previous
+    # output where possible, placeholders for all other images and for containers
+    kind = container_type(idtype)
+    metadata = {}
+    for ID in IdList:
+        if kind is not None:
+            key = group_image(groups, ID, "%s %s" % (kind, ID))
+            metadata[key] = unavailable_metadata(key, -1)
+            continue
+        row = known_metadata(openBISUser, ID, None, False, cache, False, previous)
+        metadata["%s" % group_image(groups, ID, ID)] = row if row is not None else unavailable_metadata(ID)
+    return metadata
+
+
+def fetch_core_metadata(engine, omeroUsername, idList, idtype, workers, page_size, bulk, cache=None,
+                        refresh=False, previous=None, groups=None, deadline=None, metadata=None):
+    # logs in to OMERO and returns the metadata of idList, requested with the threads or asyncio engine;
+    # while the circuit breaker is open the rows come from unavailable_core_metadata().
+    # The rows are set in 'metadata' (a MetadataTable by default, e.g. a MetadataStream) if it is given.
+    if metadata is None:
+        metadata = MetadataTable()
+    if omero_guard().is_open():
+        return unavailable_core_metadata(omeroUsername, idList, idtype, cache, previous, groups)
+    if engine == 'asyncio':
+        return asyncio.run(run_async(omeroUsername, idList, idtype, metadata, workers, page_size, bulk, cache, refresh,
+                                     previous, groups, deadline))
+    try:
+        # get omero session via JSON-API
+        with timed_phase('login'):
+            urls, session = get_omero_session(workers, deadline)
+    except OmeroUnavailable as e:
+        return unavailable_core_metadata(omeroUsername, idList, idtype, cache, previous, groups)
+    except Exception as e:
+        if deadline is not None and deadline.expired():
+            # the login did not finish in time, the images are requested again by the next run
+            return unavailable_core_metadata(omeroUsername, idList, idtype, cache, previous, groups)
+        count_metric('errors', LOGIN_FAILED)
+        print("Error in get_omero_session: ", str(e))
+        return {}
+    # get core metadata for all IDs in idList, save first ID of dict
+    with timed_phase('metadata'):
+        return get_core_metadata(omeroUsername, idList, idtype, metadata, urls, session, workers, page_size, bulk,
+                                 cache, refresh, previous, groups, deadline)
+
+
+class GrabberService:
+    # state of the resident grabber: keeps the OMERO login and its connection pool for all requests
+    def __init__(self, workers=WORKERS, page_size=PAGE_SIZE, bulk=BULK, cache=None):
+        self.workers = workers
+        self.page_size = page_size
+        self.bulk = bulk
+        self.cache = cache
+        self.omero = None
+        self.login_time = 0
+        self.lock = threading.Lock()
+
+    def omero_session(self, expired=None, deadline=None):
+        # returns the urls of the JSON API and the session, logs in again after SESSION_TTL or if the
+        # session 'expired' was dropped by OMERO (and no other request logged in again meanwhile)
+        with self.lock:
+            if (self.omero is None or time.time() - self.login_time > SESSION_TTL
+                    or (expired is not None and self.omero[1] is expired)):
+                urls, session = get_omero_session(self.workers, deadline)
+
+                def check_login(r, *args, **kwargs):
+                    # OMERO.web answers 403 once it dropped the session
+                    if r.status_code == 403:
+                        session.expired = True
+                session.expired = False
+                session.hooks['response'].append(check_login)
+                self.omero = urls, session
+                self.login_time = time.time()
+            return self.omero
+
+    def grab(self, request):
+        idList = [str(i) for i in request['ids']]
+        # the IDs become part of the request urls of the sudo session
+        if not idList or not all(ID.isdigit() for ID in idList):
+            raise ValueError("the IDs have to be numbers")
+        deadline = Deadline(request['deadline_ms']) if request.get('deadline_ms') else None
+
+        def fetch(ids, groups=None):
+            if omero_guard().is_open():
+                return unavailable_core_metadata(request['owner'], ids, request['idtype'], self.cache,
+                                                 groups=groups)
+            try:
+                urls, session = self.omero_session(deadline=deadline)
+            except Exception:
+                if deadline is None or not deadline.expired():
+                    raise
+                # the login did not finish in time, the images are requested again by the next call
+                return unavailable_core_metadata(request['owner'], ids, request['idtype'], self.cache,
+                                                 groups=groups)
+            metadata = get_core_metadata(request['owner'], ids, request['idtype'], MetadataTable(), urls, session,
+                                         self.workers, self.page_size, self.bulk, self.cache, groups=groups,
+                                         deadline=deadline)
+            if not session.expired:
+                return metadata
+            # OMERO dropped the session during the requests: log in again and repeat them
+            if groups is not None:
+                groups.clear()
+            urls, session = self.omero_session(session, deadline)
+            return get_core_metadata(request['owner'], ids, request['idtype'], MetadataTable(), urls, session,
+                                     self.workers, self.page_size, self.bulk, self.cache, groups=groups,
+                                     deadline=deadline)
+        try:
+            if SINGLEFLIGHT_DIR and fcntl is not None:
+                metadata = coalesced_core_metadata(request['owner'], idList, request['idtype'], fetch)
+            else:
+                metadata = fetch(idList)
+        finally:
+            if self.cache is not None:
+                self.cache.flush()
+        if deadline is not None and deadline.pending and self.cache is not None:
+            fill_cache_later(request['owner'], request.get('permID'), deadline.pending, workers=self.workers)
+        if not metadata:
+            return {}
+        if SAVE_OUTPUT == True:
+            try:
+                save_output(metadata, get_headers(metadata), request.get('permID'), request.get('filetype', 'json'))
+            except Exception as e:
+                print("Error in save_output(): ", str(e), file=sys.stderr)
+        return metadata
+
+    def answer(self, line):
+        # answers one JSON line {"ids": [...], "idtype": ..., "owner": ..., "permID": ...} with one JSON
+        # line holding the metadata dictionary (the same dictionary run_script() prints), with
+        # "layout": "spreadsheet" in the layout of the openBIS Spreadsheet (see iter_json()).
+        # If the request fails, the answer is {"error": "<message>"}.
+        try:
+            request = json.loads(line.decode('utf-8'))
+            layout = request.get('layout', 'dict')
+            if not hmac.compare_digest(str(request.get('secret', '')).encode('utf-8'),
+                                       DAEMON_SECRET.encode('utf-8')):
+                raise ValueError("wrong secret")
+            metadata = self.grab(request)
+        except Exception as e:
+            print("Error in grabber daemon: ", str(e), file=sys.stderr)
+            return (json.dumps({'error': str(e)}) + "\n").encode('utf-8')
+        return (''.join(iter_json(metadata, layout)) + "\n").encode('utf-8')
+
+
+def serve(workers, page_size, bulk, cache=None):
+    # runs the grabber daemon on DAEMON_HOST:DAEMON_PORT until it is interrupted
+    if not DAEMON_SECRET:
+        sys.exit("Error: set DAEMON_SECRET before starting the grabber daemon")
+    socketserver = timed_import('socketserver')
+
+    class GrabberRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(self.server.service.answer(self.rfile.readline(DAEMON_MAX_REQUEST)))
+
+    class GrabberDaemon(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    with GrabberDaemon((DAEMON_HOST, DAEMON_PORT), GrabberRequestHandler) as daemon:
+        daemon.service = GrabberService(workers, page_size, bulk, cache)
+        print("omeroJSON_grabber daemon listening on %s:%d" % (DAEMON_HOST, DAEMON_PORT), file=sys.stderr)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 def run_script():
     # needs to be run with python3 and the following arguments:
+    argparse = timed_import('argparse')
     parser = argparse.ArgumentParser(prog="Argparse")
     parser.add_argument('--filetype', '-f',
-                        help='choose output format: JSON or HTML or Markdown. Possible values: JSON, HTML, MD',
-                        nargs='?', default='json')
+                        help='choose output formats: JSON, HTML, Markdown, CSV, gzip-compressed JSON and/or Parquet. '
+                             'Possible values: JSON, HTML, MD, CSV, JSON.GZ, PARQUET (needs pyarrow) '
+                             '(space or comma separated)',
+                        nargs='+', default=['json'])
     parser.add_argument('--ids', '-i',
                         help="space separated list of OMERO IDs (e.g. 1 2 45), min. number of IDs = 1",
                         nargs='+')
@@ -318,9 +2414,72 @@ def run_script():
                         help='number to identify created file (e.g. timestamp or ELN-Object permId)',
                         action="store")
     parser.add_argument('--dtype', '-d',
-                        help='specify the type of the OMERO IDs (Possible values: IMAGES, DATASET)',
+                        help='specify the type of the OMERO IDs (Possible values: IMAGES, DATASET, PROJECT, SCREEN, '
+                             'PLATE)',
                         action="store")
-    args = parser.parse_args()
+    parser.add_argument('--workers', '-w',
+                        help='number of requests sent to OMERO at the same time (default: %d)' % WORKERS,
+                        type=int, default=WORKERS)
+    parser.add_argument('--engine', '-e',
+                        help="engine for the requests to OMERO: threads or asyncio (default: %s)" % ENGINE,
+                        choices=['threads', 'asyncio'], default=ENGINE)
+    parser.add_argument('--page-size', '-p',
+                        help='number of images requested per page of a dataset listing (default: %d)' % PAGE_SIZE,
+                        type=int, default=PAGE_SIZE)
+    parser.add_argument('--bulk', '-b',
+                        help='fill the metadata of dataset images from the dataset listing (default: %s)' % BULK,
+                        action='store_true', default=BULK)
+    parser.add_argument('--no-cache',
+                        help='neither read nor write the metadata cache METADATA_CACHE',
+                        action='store_true')
+    parser.add_argument('--refresh-cache',
+                        help='request all images again and renew their entries in the metadata cache',
+                        action='store_true')
+    parser.add_argument('--purge-cache',
+                        help='remove all entries from the metadata cache before running',
+                        action='store_true')
+    parser.add_argument('--cache-stats',
+                        help='print the counters of the negative cache as JSON and exit',
+                        action='store_true')
+    parser.add_argument('--incremental',
+                        help='reuse the rows of the previous output omero_<number>.json, request only new and failed IDs',
+                        action='store_true')
+    parser.add_argument('--revalidate',
+                        help='with --incremental: request all IDs again in the background afterwards',
+                        action='store_true')
+    parser.add_argument('--serve',
+                        help='run as daemon answering requests on DAEMON_HOST:DAEMON_PORT (needs DAEMON_SECRET)',
+                        action='store_true')
+    parser.add_argument('--profile-startup',
+                        help='print import and phase times in milliseconds as JSON to stderr',
+                        action='store_true')
+    parser.add_argument('--metrics',
+                        help='print phase times, request counts, cache hits and errors as JSON to stderr '
+                             'or append them to METRICS_FILE',
+                        action='store_true')
+    parser.add_argument('--deadline-ms',
+                        help='return after this many milliseconds, images not fetched by then get a "pending" '
+                             'row and are fetched into the metadata cache in the background (default: DEADLINE_MS)',
+                        type=int, default=DEADLINE_MS)
+    parser.add_argument('--fill-cache',
+                        help='only fetch the images into the metadata cache, without output',
+                        action='store_true')
+    parser.add_argument('--stream',
+                        help='print every row as JSON line {"<ID>": {...}} as soon as it is fetched, messages go '
+                             'to stderr',
+                        action='store_true')
+    parser.add_argument('--json-stdout',
+                        help='print the metadata dictionary as JSON, messages go to stderr',
+                        action='store_true')
+    parser.add_argument('--json-layout',
+                        help='layout of the JSON of --json-stdout and --result-file: the metadata dictionary or '
+                             '{"headers": [...], "data": [[...], ...]} (default: dict)',
+                        choices=['dict', 'spreadsheet'], default='dict')
+    parser.add_argument('--result-file',
+                        help='write the metadata dictionary as JSON to this file when the run is complete',
+                        action='store')
+    with timed_phase('arguments'):
+        args = parser.parse_args()
 
     # openBIS user calling the script
     omeroUsername = args.owner 
@@ -335,35 +2494,195 @@ def run_script():
     ident = args.number
 
     # List of output files wanted
-    ftypeList = args.filetype
+    ftypeList = parse_formats(args.filetype)
+    if 'parquet' in ftypeList and not import_parquet():
+        print("Warning: pyarrow is not installed, no Parquet file is written", file=sys.stderr)
+        ftypeList.remove('parquet')
+    if args.incremental and 'json' not in ftypeList:
+        # the next incremental run reads the JSON output
+        ftypeList.append('json')
 
-    # dictionary to store metadata
-    metadata = {}
-    try:
-        # get omero session via JSON-API
-        images_url, datasets_url, session = get_omero_session()
-    except Exception as e:
-        print("Error in get_omero_session: ", str(e))
-    try:
-        # get core metadata for all IDs in idList, save first ID of dict
-        metadata = get_core_metadata(omeroUsername, idList, idtype, metadata, images_url, datasets_url, session)
+    # Number of concurrent image requests
+    workers = max(1, args.workers)
+
+    # Number of images per page of a dataset listing
+    page_size = max(1, args.page_size)
+
+    # Take the metadata of dataset images from the dataset listing
+    bulk = args.bulk
+
+    # Metadata cache, None if it is disabled or bypassed
+    with timed_phase('cache'):
+        cache = open_metadata_cache(not args.no_cache, args.purge_cache)
+    refresh = args.refresh_cache
+    if args.cache_stats:
+        print(json.dumps(cache.stats() if cache is not None else {}))
+        if cache is not None:
+            cache.close()
+        return
+    if args.purge_cache and not idList and not args.serve:
+        # only purging was requested
+        if cache is not None:
+            cache.close()
+        return
+
+    # Run as daemon instead of answering a single request
+    if args.serve:
+        try:
+            serve(workers, page_size, bulk, cache)
+        finally:
+            if cache is not None:
+                cache.close()
+        return
+
+    # Engine for the requests: threads or asyncio
+    engine = args.engine
+    if engine == 'asyncio' and not import_async_engine():
+        print("Warning: aiohttp is not installed, using the threads engine", file=sys.stderr)
+        engine = 'threads'
+
+    # Incremental run: rows of the previous output are reused, only new IDs are requested
+    previous = None
+    if args.incremental and SAVE_OUTPUT == True:
+        previous = load_previous_output(ident)
+
+    # Latency budget of this run, counted from the start of the grabber
+    deadline = None
+    if args.deadline_ms > 0 and not args.fill_cache:
+        deadline = Deadline(args.deadline_ms, MODULE_START)
+
+    if args.stream and not args.fill_cache:
+        stream_metadata(args, omeroUsername, idList, idtype, ident, ftypeList, engine, workers, page_size, bulk,
+                        cache, refresh, previous, deadline)
+        return
+
+    # with --json-stdout stdout only carries the metadata as JSON, messages go to stderr
+    out = sys.stdout
+    messages = contextlib.ExitStack()
+    if args.json_stdout:
+        messages.enter_context(contextlib.redirect_stdout(sys.stderr))
+
+    # table to store metadata, used like the metadata dictionary
+    metadata = MetadataTable()
+    with timed_phase('cache'):
+        # with --refresh-cache the cache is not used, so it is not looked up either
+        all_known = not refresh and cached_core_metadata(omeroUsername, idList, idtype, metadata, cache,
+                                                         previous) is not None
+    if all_known:
+        # all images are cached, OMERO is not contacted at all
         headers = get_headers(metadata)
-    except Exception as e:
-        print("Error in get_core_metadata or get_headers(): ", str(e))
-        metadata = {}
+    else:
+        def fetch(ids, groups=None):
+            return fetch_core_metadata(engine, omeroUsername, ids, idtype, workers, page_size, bulk, cache,
+                                       refresh, previous, groups, deadline)
+        try:
+            if SINGLEFLIGHT_DIR and fcntl is not None:
+                # concurrent grabbers with the same IDs share their requests
+                wait = SINGLEFLIGHT_WAIT if deadline is None else min(SINGLEFLIGHT_WAIT, deadline.remaining())
+                metadata = coalesced_core_metadata(omeroUsername, idList, idtype, fetch, wait)
+            else:
+                metadata = fetch(idList)
+            headers = get_headers(metadata)
+        except Exception as e:
+            print("Error in get_core_metadata or get_headers(): ", str(e))
+            metadata = {}
+    if not isinstance(metadata, MetadataTable):
+        # rows of coalesced_core_metadata() or unavailable_core_metadata()
+        metadata = MetadataTable(metadata)
+
+    if cache is not None:
+        cache.close()
+    if args.fill_cache:
+        messages.close()
+        return
 
     # if output should be saved and metadata is not empty
     if SAVE_OUTPUT == True and bool(metadata) != False:
         try:
-            save_output(metadata, headers, ident, ftypeList)
+            with timed_phase('output'):
+                save_output(metadata, headers, ident, ftypeList)
         except Exception as e:
             print("Error in save_output(): ", str(e))
     # output should not be saved and/or metadata is empty
     else:
         pass
 
+    # the reused rows are requested again after this run has written its output
+    if previous is not None and args.revalidate:
+        spawn_background_refresh([a for a in sys.argv[1:] if a not in ('--incremental', '--revalidate')]
+                                 + ['--refresh-cache'])
+
+    # background callers pick up the result from this file, it only appears complete
+    if args.result_file:
+        try:
+            write_atomic(args.result_file, ''.join(iter_json(metadata, args.json_layout)))
+        except Exception as e:
+            print("Error in write_atomic(): ", str(e))
+
     # print errors first, then metadata
-    print(metadata)
+    messages.close()
+    if args.json_stdout:
+        out.writelines(iter_json(metadata, args.json_layout))
+        out.write('\n')
+    else:
+        print(metadata)
+
+    finish_run(args, omeroUsername, idList, idtype, ident, engine, workers, cache, deadline, len(metadata))
+
+
+def finish_run(args, omeroUsername, idList, idtype, ident, engine, workers, cache, deadline, rows):
+    # reports of the run and handling of the images which missed the deadline
+    if args.profile_startup:
+        print(json.dumps(startup_profile()), file=sys.stderr)
+    if args.metrics:
+        write_metrics(run_metrics(engine, idtype, len(idList), rows))
+
+    if deadline is not None and deadline.pending:
+        # the late images are fetched into the cache, so the next evaluation finds them there
+        if cache is not None:
+            fill_cache_later(omeroUsername, ident, deadline.pending, engine, workers)
+        # do not wait for the requests which are still running
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
+def stream_metadata(args, omeroUsername, idList, idtype, ident, ftypeList, engine, workers, page_size, bulk,
+                    cache, refresh, previous, deadline):
+    # --stream: the rows are printed as JSON lines and written to the output files while they are fetched,
+    # the metadata dictionary is never built. Singleflight is not used, as it needs all rows at once.
+    out = sys.stdout
+    try:
+        metadata = MetadataStream(out, ident if SAVE_OUTPUT == True else None, ftypeList)
+    except Exception as e:
+        print("Error in save_output(): ", str(e), file=sys.stderr)
+        metadata = MetadataStream(out)
+    # messages of the grabber must not mix with the rows
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            with timed_phase('cache'):
+                all_known = not refresh and cached_core_metadata(omeroUsername, idList, idtype, metadata,
+                                                                 cache, previous) is not None
+            if not all_known:
+                result = fetch_core_metadata(engine, omeroUsername, idList, idtype, workers, page_size, bulk,
+                                             cache, refresh, previous, None, deadline, metadata)
+                if result is not None and result is not metadata:
+                    # rows of unavailable_core_metadata()
+                    metadata.update(result)
+        except Exception as e:
+            print("Error in get_core_metadata: ", str(e))
+            metadata.close(e)
+        else:
+            metadata.close()
+        if cache is not None:
+            cache.close()
+        if previous is not None and args.revalidate:
+            spawn_background_refresh([a for a in sys.argv[1:] if a not in ('--incremental', '--revalidate')]
+                                     + ['--refresh-cache'])
+    finish_run(args, omeroUsername, idList, idtype, ident, engine, workers, cache, deadline, len(metadata))
+
+
+MODULE_LOADED = time.perf_counter()
 
 if __name__ == "__main__":
     run_script()